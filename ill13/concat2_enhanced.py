@@ -1,9 +1,29 @@
 import os
+import io
+import mmap
+import codecs
 import json
+import tokenize
 from pathlib import Path
 from datetime import datetime, timedelta
 import re
+import sys
 import time
+import hashlib
+import sqlite3
+import subprocess
+import struct
+import zlib
+import heapq
+from collections import deque
+import difflib
+import argparse
+import functools
+import contextlib
+import cProfile
+import threading
+import queue
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 # Try to import tiktoken, fall back to estimation if not available
 try:
@@ -12,6 +32,13 @@ try:
 except ImportError:
     TIKTOKEN_AVAILABLE = False
 
+# zstd output is optional; gzip from the standard library is used otherwise
+try:
+    import zstandard
+    ZSTD_AVAILABLE = True
+except ImportError:
+    ZSTD_AVAILABLE = False
+
 # Default configuration - will be written to concat_config.json if it doesn't exist
 DEFAULT_CONFIG = {
     "ignored_files": [
@@ -49,21 +76,219 @@ DEFAULT_CONFIG = {
         "red_threshold": 180000,    # Danger zone
         "yellow_threshold": 120000, # Caution zone
         "file_warning_threshold": 5000,  # 🔥 for files >5K tokens
-        "file_caution_threshold": 2000   # ⚠️ for files >2K tokens
+        "file_caution_threshold": 2000,  # ⚠️ for files >2K tokens
+        "file_token_cap": None  # Skip files above this; counting stops early
+    },
+    # Also honor .gitignore files found in the tree
+    "use_gitignore": True,
+    # Budget packing (--budget): priority weights multiply a file's value
+    "packing": {
+        "budget": None,             # Hard cap; None uses red_threshold
+        "dir_weights": {},          # e.g. {"js/classes": 2.0, "tests": 0.5}
+        "extension_weights": {},    # e.g. {"json": 0.5}
+        "backend_weight": 1.0,
+        "frontend_weight": 1.0,
+        "recency_weight": 0.0,      # Bonus for recently modified files...
+        "recency_half_life_hours": 24  # ...halving every this many hours
+    },
+    # File I/O: files at least this large are streamed instead of held in memory
+    "io": {
+        "stream_threshold_bytes": 1048576,
+        "chunk_bytes": 1048576,
+        "walk_threads": 0,  # >0 prefetches directory listings on a thread pool
+        "read_threads": 4,  # Files read ahead of tokenizing on a thread pool (0 = serial; without --jobs)
+        "mmap": True,  # Map streamed files instead of reading them through a text-mode wrapper
+        "enumerate": "walk"  # "git" lists tracked files from the git index instead (--git)
+    },
+    # Minified/generated/binary sniffing on the text each file was read with
+    "classifier": {
+        "extensions": ["js", "mjs", "cjs", "css"],  # Checked for minification; data files like JSON are often one line
+        "sample_chars": 4096,
+        "max_avg_line_length": 200,
+        "min_whitespace_ratio": 0.05,
+        "skip_generated": True  # @generated / DO NOT EDIT headers, sourceMappingURL trailers
+    },
+    # Token-reducing rewrites applied to file content as it is read, by extension. strip_comments
+    # is exact for Python (tokenize) but regex-based elsewhere: in JS/TS a regex literal holding
+    # // or /* (e.g. /[/*]/) is taken for a comment and the code is mangled
+    "transforms": {
+        "by_extension": {},  # e.g. {"js": ["strip_comments", "collapse_blank_lines"], "json": ["compact_json"]}
+        "literal_max_chars": 200  # collapse_literals shortens longer strings and number arrays
+    },
+    # Repeated content is written once; later copies refer back to it
+    "dedup": {
+        "enabled": True,
+        "near_duplicates": False,     # Write near-copies as a unified diff against their closest sibling
+        "similarity_threshold": 0.8,  # Estimated Jaccard similarity of word shingles
+        "shingle_words": 5,
+        "sketch_size": 128
+    },
+    # --shard: split the concatenation into parts of at most shard_tokens tokens
+    "sharding": {
+        "shard_tokens": None,  # None uses red_threshold
+        "write_threads": 4     # Parts written concurrently
+    },
+    # Compressed outputs (--compress): "gzip", or "zstd" when zstandard is installed
+    "compression": {
+        "format": None,  # None writes plain text; "auto" picks zstd when available
+        "level": None    # None uses the format's default (gzip 6, zstd 3)
+    },
+    # Output formatting; ansi_colors off (or --plain) keeps escape codes out of the files
+    "output": {
+        "ansi_colors": True
+    },
+    # Persistent token-count cache, stored next to concat_config.json
+    "token_cache": {
+        "enabled": True,
+        "cache_file": "concat_token_cache.sqlite",
+        "max_age_days": 30  # Entries not seen for this long are evicted
     }
 }
 
-def load_config():
+class _ProfileStage:
+    """One timed pass through a profiled stage, collecting counters as it goes"""
+    __slots__ = ("profiler", "name", "counters", "start")
+    
+    def __init__(self, profiler, name, counters):
+        self.profiler = profiler
+        self.name = name
+        self.counters = counters
+    
+    def add(self, **counters):
+        for key, value in counters.items():
+            self.counters[key] = self.counters.get(key, 0) + value
+    
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.profiler.record(self.name, self.start, time.perf_counter() - self.start, self.counters)
+        return False
+
+class _NullProfileStage:
+    """Stand-in for _ProfileStage while profiling is off"""
+    __slots__ = ()
+    
+    def add(self, **counters):
+        pass
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc_info):
+        return False
+
+_NULL_PROFILE_STAGE = _NullProfileStage()
+
+class Profiler:
+    """Per-stage wall time and counters (files, bytes, tokens) for --profile
+    
+    stage() is a shared no-op while disabled, so instrumented code costs next
+    to nothing in normal runs. Stages nest (scan_files contains read,
+    tokenize and so on), so every stage's time includes the stages inside it.
+    Work done in --jobs worker processes is only seen as the pool stage.
+    With tracing on, every pass is also kept as a Chrome trace event.
+    """
+    
+    def __init__(self):
+        self.lock = threading.Lock()  # Shard writer threads record stages concurrently
+        self.enabled = False
+        self.tracing = False
+        self.stages = {}
+        self.events = []
+        self.origin = time.perf_counter()
+    
+    def enable(self, trace=False):
+        self.enabled = True
+        self.tracing = trace
+        self.stages = {}
+        self.events = []
+        self.origin = time.perf_counter()
+    
+    def disable(self):
+        self.enabled = False
+    
+    def stage(self, name, **counters):
+        """Context manager timing one pass through the named stage"""
+        if not self.enabled:
+            return _NULL_PROFILE_STAGE
+        return _ProfileStage(self, name, counters)
+    
+    def iterate(self, name, iterable, **per_item):
+        """Yield from iterable, timing the production of each item as a pass through name"""
+        iterator = iter(iterable)
+        while True:
+            with self.stage(name, **per_item):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+    
+    def record(self, name, start, duration, counters):
+        with self.lock:
+            totals = self.stages.setdefault(name, {"calls": 0, "seconds": 0.0})
+            totals["calls"] += 1
+            totals["seconds"] += duration
+            for key, value in counters.items():
+                totals[key] = totals.get(key, 0) + value
+            if self.tracing:
+                self.events.append({
+                    "name": name, "ph": "X", "pid": os.getpid(), "tid": threading.get_ident(),
+                    "ts": (start - self.origin) * 1e6, "dur": duration * 1e6, "args": dict(counters),
+                })
+    
+    def print_summary(self):
+        """Print one row per stage, slowest first"""
+        elapsed = time.perf_counter() - self.origin
+        print(f"\n{'='*50}")
+        print("PROFILE (wall time; nested stages are included in their parents)")
+        print(f"{'='*50}")
+        print(f"{'Stage':<22}{'Calls':>8}{'Seconds':>10}{'% run':>7}{'Files':>8}{'MB':>9}{'MB/s':>9}"
+              f"{'Tokens':>12}{'Tokens/s':>15}")
+        for name, totals in sorted(self.stages.items(), key=lambda item: -item[1]["seconds"]):
+            seconds = totals["seconds"]
+            megabytes = totals.get("bytes", 0) / 1048576
+            tokens = totals.get("tokens", 0)
+            rate = f"{megabytes / seconds:9.1f}" if megabytes and seconds else f"{'':>9}"
+            token_rate = f"{tokens / seconds:15,.0f}" if tokens and seconds else f"{'':>15}"
+            print(f"{name:<22}{totals['calls']:>8,}{seconds:>10.3f}{seconds / elapsed * 100:>6.1f}%"
+                  f"{totals.get('files', 0):>8,}{megabytes:>9.2f}{rate}{tokens:>12,}{token_rate}")
+        print(f"Total wall time: {elapsed:.3f}s")
+    
+    def write_trace(self, trace_file):
+        """Write the trace events (Chrome trace format) and the stage totals as JSON"""
+        with open(trace_file, 'w', encoding='utf-8') as f:
+            json.dump({"traceEvents": self.events, "stages": self.stages}, f)
+
+# Stage timings for --profile; shared by every function in the pipeline
+PROFILER = Profiler()
+
+def profiled(name):
+    """Decorator timing every call of a function as a pass through the named stage"""
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with PROFILER.stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+@profiled("load_config")
+def load_config(config_file=None, log=print):
     """Load configuration from concat_config.json in script directory, create if doesn't exist"""
-    # Get the directory where this script is located
-    script_dir = Path(__file__).parent
-    config_file = script_dir / "concat_config.json"
+    if config_file is None:
+        # Get the directory where this script is located
+        script_dir = Path(__file__).parent
+        config_file = script_dir / "concat_config.json"
+    config_file = Path(config_file)
     
     if not config_file.exists():
-        print(f"Creating {config_file} with default settings...")
+        log(f"Creating {config_file} with default settings...")
         with open(config_file, 'w', encoding='utf-8') as f:
             json.dump(DEFAULT_CONFIG, f, indent=2)
-        print(f"Config file created! You can edit {config_file} to customize ignored files and directories.")
+        log(f"Config file created! You can edit {config_file} to customize ignored files and directories.")
         return DEFAULT_CONFIG
     
     try:
@@ -74,30 +299,252 @@ def load_config():
         for key, value in DEFAULT_CONFIG.items():
             if key not in config:
                 config[key] = value
+            elif isinstance(value, dict) and isinstance(config[key], dict):
+                for sub_key, sub_value in value.items():
+                    config[key].setdefault(sub_key, sub_value)
         
         return config
     except Exception as e:
-        print(f"Error loading {config_file}: {e}")
-        print("Using default configuration...")
+        log(f"Error loading {config_file}: {e}")
+        log("Using default configuration...")
         return DEFAULT_CONFIG
 
-def estimate_tokens(text, encoding_name="cl100k_base"):
+# Encoders loaded once per process, keyed by encoding name (None = failed to load)
+_ENCODERS = {}
+
+def get_encoder(encoding_name="cl100k_base", log=print):
+    """Return the tiktoken encoder for encoding_name, loading it once per process"""
+    if not TIKTOKEN_AVAILABLE:
+        return None
+    
+    if encoding_name not in _ENCODERS:
+        try:
+            _ENCODERS[encoding_name] = tiktoken.get_encoding(encoding_name)
+        except Exception as e:
+            log(f"Warning: tiktoken error ({e}), falling back to estimation")
+            _ENCODERS[encoding_name] = None
+    return _ENCODERS[encoding_name]
+
+# Capped counts encode text in pieces of max(cap, this) characters between checks
+CAPPED_PIECE_CHARS = 65536
+
+def estimate_tokens(text, encoding_name="cl100k_base", log=print):
     """Estimate token count using tiktoken or fallback to character/4 estimation"""
     if not text:
         return 0
     
-    if TIKTOKEN_AVAILABLE:
+    with PROFILER.stage("tokenize", bytes=len(text)) as stage:
+        encoder = get_encoder(encoding_name)
+        if encoder is not None:
+            try:
+                tokens = len(encoder.encode_ordinary(text))
+                stage.add(tokens=tokens)
+                return tokens
+            except Exception as e:
+                log(f"Warning: tiktoken error ({e}), falling back to estimation")
+        
+        # Fallback: rough estimation (characters ÷ 4)
+        stage.add(tokens=len(text) // 4)
+        return len(text) // 4
+
+def estimate_tokens_capped(text, encoding_name="cl100k_base", cap=None):
+    """Estimate text's token count, stopping early once it exceeds cap
+    
+    Past the cap the partial (> cap) count is returned, as count_stream_tokens
+    does. Text of at most cap / 4 characters can't get there (a token covers
+    at least one UTF-8 byte), so it is encoded whole.
+    """
+    if cap is None or len(text) * 4 <= cap:
+        return estimate_tokens(text, encoding_name)
+    step = max(cap, CAPPED_PIECE_CHARS)
+    return count_stream_tokens((text[start:start + step] for start in range(0, len(text), step)),
+                               encoding_name, cap)
+
+def estimate_tokens_batch(texts, encoding_name="cl100k_base", batch_size=256, cap=None, log=print):
+    """Estimate token counts for a list of texts, encoding batch_size texts per tiktoken call
+    
+    With a cap, texts long enough to exceed it are counted one at a time by
+    estimate_tokens_capped() so counting can stop early.
+    """
+    encoder = get_encoder(encoding_name)
+    if encoder is None:
+        # Timed like the tiktoken path, so --profile still shows where tokenizing went
+        with PROFILER.stage("tokenize", bytes=sum(len(text) for text in texts)) as stage:
+            counts = [len(text) // 4 for text in texts]
+            stage.add(tokens=sum(counts))
+        return counts
+    
+    if cap is not None:
+        capped = [index for index, text in enumerate(texts) if len(text) * 4 > cap]
+        if capped:
+            counts = [None] * len(texts)
+            for index in capped:
+                counts[index] = estimate_tokens_capped(texts[index], encoding_name, cap)
+            rest = [index for index, tokens in enumerate(counts) if tokens is None]
+            for index, tokens in zip(rest, estimate_tokens_batch([texts[index] for index in rest],
+                                                                 encoding_name, batch_size, log=log)):
+                counts[index] = tokens
+            return counts
+    
+    counts = []
+    for start in range(0, len(texts), batch_size):
+        batch = texts[start:start + batch_size]
         try:
-            encoding = tiktoken.get_encoding(encoding_name)
-            return len(encoding.encode(text))
-        except Exception as e:
-            print(f"Warning: tiktoken error ({e}), falling back to estimation")
+            with PROFILER.stage("tokenize", bytes=sum(len(text) for text in batch)) as stage:
+                batch_counts = [len(tokens) for tokens in encoder.encode_ordinary_batch(batch)]
+                stage.add(tokens=sum(batch_counts))
+            counts.extend(batch_counts)
+        except Exception:
+            # One bad text shouldn't cost the whole batch
+            counts.extend(estimate_tokens(text, encoding_name, log) for text in batch)
+    return counts
+
+def token_counter_key(encoding_name):
+    """Identify the counter that produced a token count (tiktoken encoding or fallback)"""
+    return encoding_name if get_encoder(encoding_name) is not None else "chars/4"
+
+def content_hash(content):
+    """Hash decoded file content for the token cache"""
+    return hashlib.blake2b(content.encode('utf-8', 'surrogatepass'), digest_size=16).hexdigest()
+
+class TokenCache:
+    """Persistent token counts keyed by path, size, mtime_ns and encoding
+    
+    A row is trusted when the file's size and mtime_ns still match. When they
+    don't, or when the mtime was too recent to be trusted at store time, the
+    content hash decides instead, so touched or re-checked-out files and
+    renamed copies are not re-tokenized. Rows not seen for max_age_days are
+    evicted on close.
+    """
+    
+    # mtimes this close to the time they were recorded may not change on the
+    # next edit (coarse filesystem timestamps), so such rows are hash-checked
+    RACY_WINDOW_NS = 2_000_000_000
+    
+    def __init__(self, cache_file, max_age_days=30):
+        self.cache_file = Path(cache_file)
+        self.max_age_days = max_age_days
+        self.hits = 0
+        self.misses = 0
+        self._now = time.time()
+        self._pending = []
+        self._seen = []
+        self.conn = sqlite3.connect(str(self.cache_file), timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS token_counts ("
+            " path TEXT NOT NULL, encoding TEXT NOT NULL,"
+            " size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL,"
+            " content_hash TEXT NOT NULL, tokens INTEGER NOT NULL,"
+            " verify INTEGER NOT NULL DEFAULT 0, last_seen REAL NOT NULL,"
+            " PRIMARY KEY (path, encoding))"
+        )
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS token_counts_hash ON token_counts (content_hash, encoding)"
+        )
+    
+    def lookup(self, filepath, stat_result, encoding_key, content=None):
+        """Return (tokens, digest); tokens is None on a miss, digest may be None if never needed
+        
+        Without content only the size/mtime match is tried (used before a file
+        is read); a hit then returns the hash recorded with the count.
+        """
+        path_key = str(filepath)
+        row = self.conn.execute(
+            "SELECT size, mtime_ns, content_hash, tokens, verify FROM token_counts"
+            " WHERE path = ? AND encoding = ?",
+            (path_key, encoding_key)
+        ).fetchone()
+        
+        if row is not None:
+            size, mtime_ns, cached_hash, tokens, verify = row
+            if size == stat_result.st_size and mtime_ns == stat_result.st_mtime_ns and not verify:
+                self.hits += 1
+                self._seen.append(path_key)
+                return tokens, cached_hash
+        
+        if content is None:
+            self.misses += 1
+            return None, None
+        
+        # Size/mtime can't vouch for the content - fall back to the content hash
+        digest = content_hash(content)
+        if row is not None and row[2] == digest:
+            tokens = row[3]
+        else:
+            match = self.conn.execute(
+                "SELECT tokens FROM token_counts WHERE content_hash = ? AND encoding = ? LIMIT 1",
+                (digest, encoding_key)
+            ).fetchone()
+            if match is None:
+                self.misses += 1
+                return None, digest
+            tokens = match[0]
+        
+        self.hits += 1
+        self.store(filepath, stat_result, encoding_key, content, tokens, digest)
+        return tokens, digest
+    
+    def store(self, filepath, stat_result, encoding_key, content, tokens, digest=None):
+        """Queue a token count for writing; rows are flushed on close"""
+        if digest is None:
+            digest = content_hash(content)
+        verify = int(time.time_ns() - stat_result.st_mtime_ns < self.RACY_WINDOW_NS)
+        self._pending.append((
+            str(filepath), encoding_key, stat_result.st_size, stat_result.st_mtime_ns,
+            digest, tokens, verify, self._now
+        ))
+    
+    def flush(self):
+        """Write pending rows and refresh last-seen times"""
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO token_counts"
+                " (path, encoding, size, mtime_ns, content_hash, tokens, verify, last_seen)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                self._pending
+            )
+            self.conn.executemany(
+                "UPDATE token_counts SET last_seen = ? WHERE path = ?",
+                [(self._now, path_key) for path_key in self._seen]
+            )
+        self._pending = []
+        self._seen = []
+        self._now = time.time()  # Long-lived users (Snapshot) flush repeatedly
+    
+    def close(self):
+        """Flush pending rows, evict stale entries and close the database"""
+        try:
+            self.flush()
+            with self.conn:
+                self.conn.execute(
+                    "DELETE FROM token_counts WHERE last_seen < ?",
+                    (self._now - self.max_age_days * 86400,)
+                )
+        finally:
+            self._pending = []
+            self._seen = []
+            self.conn.close()
+
+def open_token_cache(config, config_dir=None, log=print):
+    """Open the persistent token cache next to concat_config.json, or None if disabled/unavailable"""
+    cache_config = config.get("token_cache", DEFAULT_CONFIG["token_cache"])
+    if not cache_config.get("enabled", True):
+        return None
     
-    # Fallback: rough estimation (characters ÷ 4)
-    return len(text) // 4
+    if config_dir is None:
+        config_dir = Path(__file__).parent
+    cache_file = Path(config_dir) / cache_config.get("cache_file", "concat_token_cache.sqlite")
+    try:
+        return TokenCache(cache_file, cache_config.get("max_age_days", 30))
+    except sqlite3.Error as e:
+        log(f"Warning: token cache unavailable ({e}), counting all files")
+        return None
 
 def format_token_count(tokens, config):
-    """Format token count with color coding based on thresholds"""
+    """Format token count with color coding based on thresholds (plain with output.ansi_colors off)"""
+    if not config.get("output", DEFAULT_CONFIG["output"]).get("ansi_colors", True):
+        return f"{tokens:,}"
     red_threshold = config["token_config"]["red_threshold"]
     yellow_threshold = config["token_config"]["yellow_threshold"]
     
@@ -132,8 +579,18 @@ def get_file_warning_icon(tokens, config):
     else:
         return ""
 
-def prompt_user_continue(tokens, config, context=""):
-    """Prompt user whether to continue based on token threshold"""
+def prompt_user_continue(tokens, config, context="", policy=None):
+    """Prompt user whether to continue based on token threshold
+    
+    A policy dict ({"yes": bool, "max_tokens": int or None}) answers instead
+    of the user: totals above max_tokens are skipped, anything else continues.
+    """
+    if policy is not None and (policy.get("yes") or policy.get("max_tokens") is not None):
+        max_tokens = policy.get("max_tokens")
+        if max_tokens is not None and tokens > max_tokens:
+            return 'skip'
+        return True
+    
     status = get_threshold_status(tokens, config)
     
     if status == "green":
@@ -169,57 +626,115 @@ def prompt_user_continue(tokens, config, context=""):
         else:
             print(f"Please enter one of: {'/'.join(valid_choices)}")
 
-def is_minified(filepath):
-    """Check if a file appears to be minified based on common patterns"""
+def has_minified_name(filepath):
+    """Check filename patterns for minified files"""
     filename = filepath.name.lower()
     
-    # Check filename patterns for minified files
     if re.search(r'[\.-]min\.(js|css)$', filename):
         return True
     if re.search(r'[\.-]compressed\.(js|css)$', filename):
         return True
+    return False
+
+# Headers tools put on a generated file's first few lines: a comment carrying @generated or a
+# case-sensitive DO NOT EDIT (as in Go's "// Code generated by ... DO NOT EDIT."); prose that
+# merely mentions editing or generation doesn't count. Also the trailer bundlers append.
+GENERATED_HEADER_LINES = 5
+GENERATED_MARKERS = re.compile(r'^\s*(?://|#|/?\*|<!--|--|;).*(?:@generated\b|\bDO NOT EDIT\b)', re.MULTILINE)
+SOURCE_MAP_MARKER = re.compile(r'[#@] sourceMappingURL=')
+
+def is_binary_sample(head):
+    """Whether a file's first bytes can't be UTF-8 text: a NUL byte, or bytes that don't decode"""
+    if b'\x00' in head:
+        return True
+    try:
+        head.decode('utf-8')
+    except UnicodeDecodeError as e:
+        # A multi-byte character cut off at the end of the sample is still text
+        return e.reason != 'unexpected end of data'
+    return False
+
+def classify_content(filepath, text, settings=None):
+    """Classify a file from text the scan already read: None, 'minified', 'generated' or 'binary'
+    
+    text is the whole decoded content or the first chunk of a streamed file;
+    only its first sample_chars characters (and its tail, for the source-map
+    trailer) are looked at, so classifying never touches the disk. NUL bytes
+    mean binary; a tool's generated-file header in the first lines or a
+    sourceMappingURL trailer means generated; for the configured extensions,
+    a long average line length or too little whitespace means minified.
+    """
+    if settings is None:
+        settings = DEFAULT_CONFIG["classifier"]
+    sample = text[:settings.get("sample_chars", 4096)]
+    
+    if '\x00' in sample:
+        return "binary"
+    if has_minified_name(filepath):
+        return "minified"
+    
+    suffix = filepath.suffix.lower().lstrip('.')
+    if settings.get("skip_generated", True):
+        header = '\n'.join(sample.split('\n', GENERATED_HEADER_LINES)[:GENERATED_HEADER_LINES])
+        if GENERATED_MARKERS.search(header):
+            return "generated"
+        if suffix in ('js', 'mjs', 'cjs', 'css') and SOURCE_MAP_MARKER.search(text[-512:]):
+            return "generated"
+    
+    if suffix not in settings.get("extensions", []):
+        return None
+    
+    # Characteristics of minified files:
+    first_chunk = sample[:1024]
+    if len(first_chunk) > 500:
+        if len(first_chunk.split('\n')[0]) > 500:
+            return "minified"
+        if first_chunk.count('\n') < 3:
+            return "minified"
+    if suffix == 'css' and re.search(r'[};][^\n\s]', first_chunk):
+        return "minified"
+    
+    if len(sample) > 500:
+        average_line = len(sample) / (sample.count('\n') + 1)
+        if average_line > settings.get("max_avg_line_length", 200):
+            return "minified"
+        whitespace = len(sample) - len(''.join(sample.split()))
+        if whitespace / len(sample) < settings.get("min_whitespace_ratio", 0.05):
+            return "minified"
+    return None
+
+def is_minified(filepath, content=None):
+    """Check if a file appears to be minified based on common patterns"""
+    if has_minified_name(filepath):
+        return True
     
-    # For larger files, check content
-    if filepath.suffix.lower() in ['.js', '.css']:
+    if content is None:
         try:
-            # Read first few lines to check for minification patterns
             with open(filepath, 'r', encoding='utf-8') as f:
-                first_chunk = f.read(1024)  # Read first 1KB
-                
-                # Characteristics of minified files:
-                if filepath.suffix.lower() == '.js':
-                    if len(first_chunk.split('\n')[0]) > 500:
-                        return True
-                    if first_chunk.count('\n') < 3 and len(first_chunk) > 500:
-                        return True
-                    
-                elif filepath.suffix.lower() == '.css':
-                    if first_chunk.count('\n') < 3 and len(first_chunk) > 500:
-                        return True
-                    if re.search(r'[};][^\n\s]', first_chunk):
-                        return True
-                        
+                content = f.read(DEFAULT_CONFIG["classifier"]["sample_chars"])
         except Exception:
             return False
-            
-    return False
+    return classify_content(filepath, content) == "minified"
 
-def is_recently_modified(filepath, minutes_ago):
+def is_recently_modified(filepath, minutes_ago, stat_result=None):
     """Check if file was modified within the last X minutes"""
     if minutes_ago is None:
         return True
     
     try:
-        file_mtime = filepath.stat().st_mtime
+        if stat_result is None:
+            stat_result = filepath.stat()
+        file_mtime = stat_result.st_mtime
         file_datetime = datetime.fromtimestamp(file_mtime)
         cutoff_time = datetime.now() - timedelta(minutes=minutes_ago)
         return file_datetime >= cutoff_time
     except Exception:
         return True
 
-def get_output_filenames(mode, minutes_ago=None):
+def get_output_filenames(mode, minutes_ago=None, current_dir=None):
     """Generate output filenames based on the root directory name and mode"""
-    current_dir = Path.cwd()
+    if current_dir is None:
+        current_dir = Path.cwd()
     root_name = current_dir.name
     
     timestamp_suffix = f"_last_{minutes_ago}min" if minutes_ago else ""
@@ -236,157 +751,1742 @@ def get_output_filenames(mode, minutes_ago=None):
     
     return concat_file, tree_file
 
-def should_ignore_file(filename, root_name=None, config=None):
-    """Check if a file should be ignored based on configuration"""
-    if config is None:
-        config = DEFAULT_CONFIG
+def get_manifest_filename(mode, minutes_ago=None, current_dir=None):
+    """NDJSON manifest filename matching get_output_filenames()"""
+    if current_dir is None:
+        current_dir = Path.cwd()
+    timestamp_suffix = f"_last_{minutes_ago}min" if minutes_ago else ""
+    return f"{current_dir.name}_{mode}_manifest{timestamp_suffix}.ndjson"
+
+# Root-level files treated as backend regardless of extension
+ROOT_BACKEND_FILES = frozenset(['requirements.txt', 'dockerfile.txt', 'main.py', 'pyproject.toml'])
+
+def glob_to_regex(pattern):
+    """Translate a gitignore-style glob into a regex over '/'-separated relative paths
+    
+    '*' and '?' stay within one path segment, '**' spans segments and '[...]'
+    is a character class. Patterns with a '/' before their end are anchored
+    to the base directory; others match at any depth.
+    """
+    anchored = '/' in pattern.rstrip('/')
+    pattern = pattern.strip('/')
+    
+    parts = []
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        if pattern.startswith('**', i):
+            at_segment_start = i == 0 or pattern[i - 1] == '/'
+            if at_segment_start and pattern.startswith('**/', i):
+                parts.append('(?:.*/)?')
+                i += 3
+                continue
+            parts.append('.*')
+            i += 2
+            continue
+        if char == '*':
+            parts.append('[^/]*')
+        elif char == '?':
+            parts.append('[^/]')
+        elif char == '[':
+            close = pattern.find(']', i + 2)
+            if close == -1:
+                parts.append(re.escape(char))
+            else:
+                body = pattern[i + 1:close]
+                if body.startswith('!'):
+                    body = '^' + body[1:]
+                parts.append('[' + body.replace('\\', '\\\\') + ']')
+                i = close
+        elif char == '\\' and i + 1 < len(pattern):
+            i += 1
+            parts.append(re.escape(pattern[i]))
+        else:
+            parts.append(re.escape(char))
+        i += 1
+    
+    body = ''.join(parts)
+    return re.compile(('^' if anchored else '^(?:.*/)?') + body + '$')
+
+def compile_ignore_rules(lines, base=""):
+    """Compile gitignore-style lines into (base, regex, negate, dir_only) rules, in file order"""
+    rules = []
+    for line in lines:
+        line = line.rstrip('\n').rstrip('\r')
+        if not line.strip() or line.startswith('#'):
+            continue
+        if not line.endswith('\\ '):
+            line = line.rstrip()
+        negate = line.startswith('!')
+        if negate:
+            line = line[1:]
+        elif line.startswith('\\!') or line.startswith('\\#'):
+            line = line[1:]
+        dir_only = line.endswith('/')
+        if line.strip('/'):
+            rules.append((base, glob_to_regex(line), negate, dir_only))
+    return rules
+
+class PathMatcher:
+    """Include/ignore decisions compiled once per scan from concat_config.json
+    
+    Plain names in ignored_files/ignored_dirs are set lookups. Entries with
+    glob characters, a '/' or a leading '!' are compiled as gitignore-style
+    rules (last match wins, '!' re-includes). With use_gitignore, .gitignore
+    files met during the walk add rules scoped to their directory; they are
+    applied first, so the config has the final say. Ignored directories are
+    pruned before they are descended into.
+    """
+    
+    def __init__(self, config, root_name):
+        self.config = config
+        self.use_gitignore = config.get("use_gitignore", True)
+        self.backend_extensions = frozenset(config['backend_extensions'])
+        self.frontend_extensions = frozenset(config['frontend_extensions'])
+        self.all_extensions = self.backend_extensions | self.frontend_extensions
+        self.backend_dirs = frozenset(config['backend_dirs'])
+        
+        self.ignored_file_names, file_patterns = self._split_entries(config['ignored_files'])
+        self.ignored_dir_names, dir_patterns = self._split_entries(config['ignored_dirs'])
+        self.file_rules = tuple(compile_ignore_rules(file_patterns))
+        self.dir_rules = tuple(compile_ignore_rules(dir_patterns))
+        self._combined = {}
+        
+        # Files this script writes, so a snapshot never includes an older one
+        self.output_prefixes = tuple(f"{root_name}_{kind}" for kind in (
+            "combined_files", "file_tree", "frontend_files", "backend_files",
+            "frontend_tree", "backend_tree", "all_files", "all_tree",
+            "frontend_manifest", "backend_manifest", "all_manifest"
+        ))
+        
+        # .gitignore rules in effect per directory (relative posix path)
+        self.gitignore_rules = {"": ()}
+    
+    @staticmethod
+    def _split_entries(entries):
+        names = set()
+        patterns = []
+        for entry in entries:
+            if entry.startswith('!') or any(char in entry for char in '*?[/'):
+                patterns.append(entry)
+            else:
+                names.add(entry)
+        return frozenset(names), patterns
+    
+    def _combined_rules(self, rules, is_dir):
+        """Merge a rule set without negations into one regex per base directory
+        
+        Without '!' rules the order doesn't matter, so a single alternation
+        answers "does anything match" in one regex call. Returns None when the
+        rules must be evaluated in order.
+        """
+        key = (id(rules), is_dir)
+        if key not in self._combined:
+            applicable = [rule for rule in rules if is_dir or not rule[3]]
+            if any(negate for _, _, negate, _ in applicable):
+                self._combined[key] = None
+            else:
+                by_base = {}
+                for base, regex, _, _ in applicable:
+                    by_base.setdefault(base, []).append(regex.pattern)
+                self._combined[key] = [
+                    (base, re.compile('|'.join(f'(?:{pattern})' for pattern in patterns)))
+                    for base, patterns in by_base.items()
+                ]
+        return self._combined[key]
+    
+    def _match_rules(self, rules, relative_path, is_dir, verdict):
+        if not rules:
+            return verdict
+        
+        combined = self._combined_rules(rules, is_dir)
+        if combined is not None:
+            if verdict:
+                return True
+            for base, regex in combined:
+                if base:
+                    if not relative_path.startswith(base + "/"):
+                        continue
+                    subject = relative_path[len(base) + 1:]
+                else:
+                    subject = relative_path
+                if regex.match(subject):
+                    return True
+            return False
+        
+        for base, regex, negate, dir_only in rules:
+            if dir_only and not is_dir:
+                continue
+            if base:
+                if not relative_path.startswith(base + "/"):
+                    continue
+                subject = relative_path[len(base) + 1:]
+            else:
+                subject = relative_path
+            if regex.match(subject):
+                verdict = not negate
+        return verdict
+    
+    def enter_directory(self, dir_path, relative_dir, filenames):
+        """Load the directory's .gitignore (if the walk listed one) on top of its parent's rules"""
+        parent = relative_dir.rpartition('/')[0] if relative_dir else ""
+        rules = self.gitignore_rules.get(parent, ())
+        if self.use_gitignore and '.gitignore' in filenames:
+            try:
+                with open(os.path.join(dir_path, '.gitignore'), 'r', encoding='utf-8') as f:
+                    rules = rules + tuple(compile_ignore_rules(f, relative_dir))
+            except (OSError, UnicodeDecodeError):
+                pass
+        self.gitignore_rules[relative_dir] = rules
+    
+    def ignores_dir(self, dirname, relative_dir):
+        """Check if a directory should be pruned from the walk"""
+        parent = relative_dir.rpartition('/')[0]
+        ignored = self._match_rules(self.gitignore_rules.get(parent, ()), relative_dir, True, False)
+        ignored = ignored or dirname in self.ignored_dir_names or dirname.lower() == 'git'
+        return self._match_rules(self.dir_rules, relative_dir, True, ignored)
+    
+    def ignores_file(self, filename, relative_file):
+        """Check if a file should be ignored based on configuration, outputs and .gitignore"""
+        parent = relative_file.rpartition('/')[0]
+        ignored = self._match_rules(self.gitignore_rules.get(parent, ()), relative_file, False, False)
+        ignored = ignored or filename in self.ignored_file_names or filename.startswith(self.output_prefixes)
+        return self._match_rules(self.file_rules, relative_file, False, ignored)
+    
+    def is_backend(self, relative_file):
+        """Determine if a file path belongs to backend based on directory structure"""
+        first_dir, separator, rest = relative_file.partition('/')
+        if separator:
+            return first_dir in self.backend_dirs
+        
+        # Root level: backend extensions and known config files
+        return (os.path.splitext(relative_file)[1].lstrip('.') in self.backend_extensions
+                or relative_file in ROOT_BACKEND_FILES)
+    
+    def includes_file(self, filename, relative_file, mode):
+        """Check if file should be included based on mode (frontend/backend/all)"""
+        file_ext = os.path.splitext(filename)[1].lstrip('.')
+        
+        if mode == 'all':
+            return file_ext in self.all_extensions
+        if mode == 'backend':
+            return file_ext in self.backend_extensions and self.is_backend(relative_file)
+        return file_ext in self.frontend_extensions and not self.is_backend(relative_file)
+
+# Output suffix and default level of each compression format
+COMPRESSION_FORMATS = {"gzip": (".gz", 6), "zstd": (".zst", 3)}
+# Uncompressed bytes handed to the compressor thread at a time, and how many may queue up
+COMPRESS_CHUNK_BYTES = 1048576
+COMPRESS_QUEUE_CHUNKS = 16
+
+class BackgroundCompressor(io.BufferedIOBase):
+    """Binary sink that compresses into a file on a background thread
+    
+    write() only queues the data (in COMPRESS_CHUNK_BYTES pieces, at most
+    COMPRESS_QUEUE_CHUNKS waiting), so compression and the disk writes
+    overlap whatever the writer does next. zlib and zstandard release the
+    GIL while compressing. An error on the thread is raised by the next
+    write() or by close(). tell() counts uncompressed bytes.
+    """
+    
+    def __init__(self, output_file, compression_format, level):
+        super().__init__()
+        if compression_format == "zstd":
+            self.compressor = zstandard.ZstdCompressor(level=level).compressobj()
+        else:
+            self.compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)  # gzip framing
+        self.file = open(output_file, 'wb')
+        self.position = 0
+        self.error = None
+        self.queue = queue.Queue(maxsize=COMPRESS_QUEUE_CHUNKS)
+        self.thread = threading.Thread(target=self._run, name="compressor", daemon=True)
+        self.thread.start()
     
-    # Check explicit ignore list
-    if filename in config['ignored_files']:
+    def _run(self):
+        try:
+            while True:
+                chunk = self.queue.get()
+                if chunk is None:
+                    break
+                self.file.write(self.compressor.compress(chunk))
+            self.file.write(self.compressor.flush())
+        except Exception as e:
+            self.error = e
+            # Keep draining so the writer never blocks on a full queue
+            while self.queue.get() is not None:
+                pass
+    
+    def writable(self):
         return True
     
-    # Get current directory name if not provided
-    if root_name is None:
-        root_name = Path.cwd().name
-    
-    # Check if file matches output filename patterns
-    output_patterns = [
-        f"{root_name}_combined_files",
-        f"{root_name}_file_tree",
-        f"{root_name}_frontend_files",
-        f"{root_name}_backend_files",
-        f"{root_name}_frontend_tree",
-        f"{root_name}_backend_tree",
-        f"{root_name}_all_files",
-        f"{root_name}_all_tree"
-    ]
+    def write(self, data):
+        if self.error is not None:
+            raise self.error
+        with memoryview(data) as view:
+            for start in range(0, view.nbytes, COMPRESS_CHUNK_BYTES):
+                self.queue.put(view[start:start + COMPRESS_CHUNK_BYTES].tobytes())
+            self.position += view.nbytes
+            return view.nbytes
     
-    for pattern in output_patterns:
-        if filename.startswith(pattern):
-            return True
+    def tell(self):
+        return self.position
+    
+    def close(self):
+        if self.closed:
+            return
+        try:
+            self.queue.put(None)
+            self.thread.join()
+        finally:
+            self.file.close()
+            super().close()
+        if self.error is not None:
+            raise self.error
+
+def resolve_compression(config, log=print):
+    """(format, level) for the configured output compression, or None for plain text"""
+    compression = config.get("compression", DEFAULT_CONFIG["compression"])
+    compression_format = compression.get("format")
+    if not compression_format:
+        return None
+    if compression_format == "auto":
+        compression_format = "zstd" if ZSTD_AVAILABLE else "gzip"
+    if compression_format not in COMPRESSION_FORMATS:
+        raise ValueError(f"unknown compression format: {compression_format}")
+    if compression_format == "zstd" and not ZSTD_AVAILABLE:
+        log("⚠️  zstandard is not installed (pip install zstandard); compressing with gzip instead")
+        compression_format = "gzip"
+        compression = dict(compression, level=None)
+    level = compression.get("level")
+    return compression_format, COMPRESSION_FORMATS[compression_format][1] if level is None else level
+
+def compressed_filename(output_file, config):
+    """Output path with the configured compression's suffix added (if it isn't there already)"""
+    compression = resolve_compression(config)
+    if compression is None:
+        return output_file
+    suffix = COMPRESSION_FORMATS[compression[0]][0]
+    output_file = Path(output_file)
+    return output_file if output_file.suffix == suffix else output_file.with_name(output_file.name + suffix)
+
+def open_output(output_file, config):
+    """Open a text output for writing, through a background compressor if one is configured
+    
+    An already-open stream (anything with a write method) is used as is and
+    left open when the with block ends.
+    """
+    if hasattr(output_file, "write"):
+        return contextlib.nullcontext(output_file)
+    compression = resolve_compression(config)
+    if compression is None:
+        return open(output_file, 'w', encoding='utf-8')
+    return io.TextIOWrapper(BackgroundCompressor(output_file, *compression), encoding='utf-8')
+
+def list_directory(path):
+    """List a directory in one scandir pass; returns (dir entries, file entries) or None on error"""
+    dir_entries = []
+    file_entries = []
+    try:
+        with os.scandir(path) as iterator:
+            for entry in iterator:
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    is_dir = False
+                (dir_entries if is_dir else file_entries).append(entry)
+    except OSError:
+        return None
+    return dir_entries, file_entries
+
+def walk_tree(top, threads=0):
+    """Top-down walk in os.walk order that keeps scandir's DirEntry objects
+    
+    Yields (path, dir_entries, file_entries). As with os.walk the caller may
+    prune dir_entries in place, unreadable directories are skipped and
+    symlinked directories are listed but not followed. DirEntry caches its
+    stat(), so filtering, the time filter and header rendering share a single
+    stat per file (none at all on Windows, where scandir returns it). With
+    threads > 0 subdirectory listings are prefetched on a thread pool, which
+    hides latency on network or slow filesystems; the order is unchanged.
+    """
+    executor = ThreadPoolExecutor(max_workers=threads) if threads > 0 else None
+    prefetched = {}
+    stack = [os.fspath(top)]
+    try:
+        while stack:
+            path = stack.pop()
+            future = prefetched.pop(path, None)
+            listed = future.result() if future is not None else list_directory(path)
+            if listed is None:
+                continue
             
-    return False
+            dir_entries, file_entries = listed
+            yield path, dir_entries, file_entries
+            
+            children = []
+            for entry in dir_entries:
+                try:
+                    if entry.is_symlink():
+                        continue
+                except OSError:
+                    continue
+                children.append(entry.path)
+            if executor is not None:
+                for child in children:
+                    prefetched[child] = executor.submit(list_directory, child)
+            stack.extend(reversed(children))
+    finally:
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
 
-def should_ignore_dir(dirname, config=None):
-    """Check if a directory should be ignored"""
-    if config is None:
-        config = DEFAULT_CONFIG
-    return dirname in config['ignored_dirs'] or dirname.lower() == 'git'
+def run_git(root, *args):
+    """Run a git command in root; returns its stdout bytes, RuntimeError if it fails"""
+    try:
+        result = subprocess.run(["git", "-C", os.fspath(root), *args], capture_output=True)
+    except OSError as e:
+        raise RuntimeError(f"could not run git: {e}")
+    if result.returncode != 0:
+        message = result.stderr.decode('utf-8', errors='replace').strip() or f"exit status {result.returncode}"
+        raise RuntimeError(f"git {args[0]} failed: {message}")
+    return result.stdout
+
+def split_git_paths(output):
+    """Paths from NUL-separated (-z) git output, relative to the directory git ran in"""
+    return [os.fsdecode(path) for path in output.split(b"\0") if path]
 
-def is_backend_path(filepath, root_path, config):
-    """Determine if a file path belongs to backend based on directory structure"""
-    relative_path = filepath.relative_to(root_path)
+def git_index_files(root, since=None):
+    """Files under root from the git index, as {relative posix path: blob hash}
     
-    # Check if in root directory
-    if len(relative_path.parts) == 1:
-        # Root level Python files are backend
-        if filepath.suffix.lstrip('.') in config['backend_extensions']:
-            return True
-        # Root level config files are backend
-        if filepath.name in ['requirements.txt', 'dockerfile.txt', 'main.py', 'pyproject.toml']:
-            return True
+    Submodules and tracked files missing from the working tree are left out.
+    With since (any revision), only files changed between it and the working
+    tree are kept, including staged, unstaged and untracked (but not ignored)
+    files; untracked files have no blob hash.
+    """
+    files = {}
+    for entry in split_git_paths(run_git(root, "ls-files", "--stage", "-z")):
+        meta, _, path = entry.partition("\t")
+        mode, blob = meta.split(" ")[:2]
+        if mode != "160000":  # Submodule commits aren't files
+            files[path] = blob
+    for path in split_git_paths(run_git(root, "ls-files", "--deleted", "-z")):
+        files.pop(path, None)
+    
+    if since is None:
+        return files
+    try:
+        if since.startswith("-"):
+            raise RuntimeError(since)
+        commit = run_git(root, "rev-parse", "--verify", "--quiet", f"{since}^{{commit}}").decode().strip()
+    except RuntimeError:
+        raise RuntimeError(f"not a commit: {since}") from None
+    changed = split_git_paths(run_git(root, "diff", "--name-only", "--relative", "--diff-filter=d", "-z",
+                                      commit, "--"))
+    changed += split_git_paths(run_git(root, "ls-files", "--others", "--exclude-standard", "-z"))
+    return {path: files.get(path) for path in changed}
+
+class IndexEntry:
+    """os.DirEntry stand-in for a path listed by the git index; stats on first use"""
+    __slots__ = ("name", "path", "_is_dir", "_stat")
+    
+    def __init__(self, path, name, is_dir):
+        self.name = name
+        self.path = path
+        self._is_dir = is_dir
+        self._stat = None
+    
+    def is_dir(self):
+        return self._is_dir
+    
+    def is_symlink(self):
         return False
     
-    # Check first directory in path
-    first_dir = relative_path.parts[0]
-    return first_dir in config['backend_dirs']
+    def stat(self):
+        if self._stat is None:
+            self._stat = os.stat(self.path)
+        return self._stat
 
-def should_include_file(filepath, root_path, mode, config):
-    """Check if file should be included based on mode (frontend/backend/all)"""
-    file_ext = filepath.suffix.lstrip('.')
+def walk_git_index(top, relative_paths):
+    """walk_tree() over a list of relative file paths (e.g. from git_index_files) instead of the disk
     
-    if mode == 'all':
-        return file_ext in (config['backend_extensions'] + config['frontend_extensions'])
+    Yields (path, dir_entries, file_entries) top-down with names sorted;
+    only directories holding listed files appear, so ignored build trees are
+    never visited. Pruning dir_entries in place works as with walk_tree.
+    """
+    top = os.fspath(top)
+    listings = {"": (set(), [])}
+    for relative in sorted(relative_paths):
+        parent, _, name = relative.rpartition('/')
+        missing = []
+        directory = parent
+        while directory not in listings:
+            missing.append(directory)
+            directory = directory.rpartition('/')[0]
+        for directory in reversed(missing):
+            listings[directory] = (set(), [])
+            grandparent, _, dirname = directory.rpartition('/')
+            listings[grandparent][0].add(dirname)
+        listings[parent][1].append(name)
+    
+    stack = [""]
+    while stack:
+        relative_dir = stack.pop()
+        path = os.path.join(top, relative_dir) if relative_dir else top
+        subdirs, names = listings[relative_dir]
+        dir_entries = [IndexEntry(os.path.join(path, name), name, True) for name in sorted(subdirs)]
+        file_entries = [IndexEntry(os.path.join(path, name), name, False) for name in names]
+        yield path, dir_entries, file_entries
+        prefix = relative_dir + "/" if relative_dir else ""
+        stack.extend(prefix + entry.name for entry in reversed(dir_entries))
+
+# Bytes read from the front (and back) of a binary file to sniff and hash it
+BINARY_SAMPLE_BYTES = 65536
+JPEG_SOF_MARKERS = frozenset(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+def read_image_dimensions(file_handle, head):
+    """Image format and (width, height) from a binary file's first bytes, or None if not an image
+    
+    Formats are told apart by their signatures, not their extensions. PNG,
+    GIF, BMP and WebP keep their dimensions in the first 30 bytes; for JPEG
+    and TIFF the handle is seeked through segment and IFD headers, so the
+    pixel data itself is never read. Dimensions are None when the header
+    doesn't have them where expected.
+    """
+    try:
+        if head[:8] == b'\x89PNG\r\n\x1a\n':
+            if head[12:16] == b'IHDR':
+                return "png", struct.unpack('>II', head[16:24])
+            return "png", None
+        
+        if head[:6] in (b'GIF87a', b'GIF89a'):
+            return "gif", struct.unpack('<HH', head[6:10])
+        
+        if head[:2] == b'BM' and struct.unpack('<I', head[14:18])[0] in (12, 40, 52, 56, 64, 108, 124):
+            if struct.unpack('<I', head[14:18])[0] == 12:
+                return "bmp", struct.unpack('<HH', head[18:22])
+            width, height = struct.unpack('<ii', head[18:26])
+            return "bmp", (width, abs(height))
+        
+        if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+            chunk = head[12:16]
+            if chunk == b'VP8 ' and head[23:26] == b'\x9d\x01\x2a':
+                width, height = struct.unpack('<HH', head[26:30])
+                return "webp", (width & 0x3fff, height & 0x3fff)
+            if chunk == b'VP8L' and head[20:21] == b'\x2f':
+                bits = struct.unpack('<I', head[21:25])[0]
+                return "webp", ((bits & 0x3fff) + 1, ((bits >> 14) & 0x3fff) + 1)
+            if chunk == b'VP8X':
+                return "webp", (int.from_bytes(head[24:27], 'little') + 1,
+                                int.from_bytes(head[27:30], 'little') + 1)
+            return "webp", None
+        
+        if head[:3] == b'\xff\xd8\xff':
+            return "jpeg", read_jpeg_dimensions(file_handle)
+        
+        if head[:4] in (b'II*\x00', b'MM\x00*'):
+            return "tiff", read_tiff_dimensions(file_handle, '<' if head[:2] == b'II' else '>')
+    except struct.error:
+        pass
+    return None
+
+def read_jpeg_dimensions(file_handle):
+    """Walk JPEG segment headers to the first start-of-frame marker"""
+    position = 2
+    for _ in range(1024):
+        file_handle.seek(position)
+        marker = file_handle.read(4)
+        if len(marker) < 4 or marker[0] != 0xFF:
+            return None
+        if marker[1] == 0xFF:  # Fill byte
+            position += 1
+            continue
+        if marker[1] in JPEG_SOF_MARKERS:
+            frame = file_handle.read(5)
+            if len(frame) < 5:
+                return None
+            height, width = struct.unpack('>HH', frame[1:5])
+            return width, height
+        if marker[1] == 0x01 or 0xD0 <= marker[1] <= 0xD9:  # Markers without a length
+            position += 2
+            continue
+        position += 2 + struct.unpack('>H', marker[2:4])[0]
+    return None
+
+def read_tiff_dimensions(file_handle, order):
+    """Read ImageWidth and ImageLength from a TIFF's first IFD"""
+    file_handle.seek(4)
+    ifd_offset = struct.unpack(order + 'I', file_handle.read(4))[0]
+    file_handle.seek(ifd_offset)
+    count = struct.unpack(order + 'H', file_handle.read(2))[0]
+    entries = file_handle.read(12 * min(count, 512))
+    found = {}
+    for index in range(0, len(entries) - 11, 12):
+        tag, field_type = struct.unpack(order + 'HH', entries[index:index + 4])
+        if tag in (256, 257):
+            value_format = 'H' if field_type == 3 else 'I'
+            found[tag] = struct.unpack(order + value_format,
+                                       entries[index + 8:index + 8 + struct.calcsize(value_format)])[0]
+    if 256 in found and 257 in found:
+        return found[256], found[257]
+    return None
+
+def read_image_stub(file_handle, head):
+    """Compact metadata text standing in for an image's content, or None if it isn't one
+    
+    The fingerprint hashes the size plus the first and last
+    BINARY_SAMPLE_BYTES, so only those are read however large the image is;
+    it is labelled as sampled because images that differ only in the middle
+    share it. The stub is the same handful of tokens whatever the payload.
+    """
+    image = read_image_dimensions(file_handle, head)
+    if image is None:
+        return None
+    image_format, dimensions = image
     
-    is_backend = is_backend_path(filepath, root_path, config)
+    size = os.fstat(file_handle.fileno()).st_size
+    hasher = hashlib.blake2b(head, digest_size=16)
+    hasher.update(str(size).encode())
+    if size > BINARY_SAMPLE_BYTES:
+        file_handle.seek(max(BINARY_SAMPLE_BYTES, size - BINARY_SAMPLE_BYTES))
+        hasher.update(file_handle.read(BINARY_SAMPLE_BYTES))
     
-    if mode == 'backend':
-        return is_backend and file_ext in config['backend_extensions']
-    else:  # frontend
-        return not is_backend and file_ext in config['frontend_extensions']
+    description = f"{image_format} {dimensions[0]}x{dimensions[1]}" if dimensions else image_format
+    return {
+        "content": f"[binary image: {description}, {size:,} bytes, sampled fingerprint {hasher.hexdigest()}]",
+        "image": description,
+    }
 
-def calculate_directory_tokens(dir_path, current_dir, mode, config, minutes_ago=None):
-    """Calculate total tokens for all files in a directory"""
-    total_tokens = 0
-    file_count = 0
+def read_result(content=None, verdict=None, error=None, tokens=None, streamed=False,
+                has_cr=None, digest=None, image=None):
+    """Outcome of reading one candidate file, applied to its manifest record
     
+    Process-pool workers also fill stage_tokens (counts before and after
+    each transform step) and stage_digests (hashes of the stages they counted).
+    """
+    return {"content": content, "verdict": verdict, "error": error, "tokens": tokens,
+            "streamed": streamed, "has_cr": has_cr, "digest": digest, "image": image,
+            "stage_tokens": None, "stage_digests": None}
+
+def read_source_file(filepath, settings=None):
+    """Read a candidate file once and classify it
+    
+    The first bytes are checked for an image signature before anything is
+    decoded; images are answered with a metadata stub instead of being read
+    whole. Text is decoded with the newline translation a text-mode read does.
+    """
     try:
-        for item in dir_path.iterdir():
-            if item.is_file():
-                if (should_include_file(item, current_dir, mode, config) and
-                    not should_ignore_file(item.name, current_dir.name, config) and
-                    not is_minified(item) and
-                    is_recently_modified(item, minutes_ago)):
-                    
+        with PROFILER.stage("read", files=1) as stage, open(filepath, 'rb') as file_handle:
+            head = file_handle.read(BINARY_SAMPLE_BYTES)
+            stub = read_image_stub(file_handle, head)
+            if stub is not None:
+                stage.add(bytes=len(head))
+                return read_result(stub["content"], image=stub["image"])
+            if is_binary_sample(head):
+                stage.add(bytes=len(head))
+                return read_result(verdict="binary")
+            data = head + file_handle.read()
+            stage.add(bytes=len(data))
+        with PROFILER.stage("decode", bytes=len(data)):
+            content = data.decode('utf-8').replace('\r\n', '\n').replace('\r', '\n')
+    except Exception as e:
+        return read_result(error=e)
+    
+    with PROFILER.stage("classify", files=1):
+        verdict = classify_content(filepath, content, settings)
+    if verdict is not None:
+        return read_result(verdict=verdict)
+    return read_result(content)
+
+def find_token_safe_cut(text, start=0):
+    """Index where text can be cut without changing its token count, or None
+    
+    Prefers the last newline followed by a non-space character; failing that,
+    the last single space followed by a non-space character. Tiktoken's
+    pre-tokenizer never merges tokens across either point, so counting both
+    halves separately gives the same total as counting the whole.
+    """
+    end = len(text) - 1
+    index = text.rfind('\n', start, end)
+    while index != -1:
+        if not text[index + 1].isspace():
+            return index + 1
+        index = text.rfind('\n', start, index)
+    
+    index = text.rfind(' ', 1, end)
+    while index != -1:
+        if not text[index + 1].isspace():
+            return index
+        index = text.rfind(' ', 1, index)
+    return None
+
+def count_stream_tokens(chunks, encoding_name="cl100k_base", cap=None, max_carry=4194304):
+    """Count tokens over an iterable of text chunks without joining them
+    
+    Text is only cut at points find_token_safe_cut() accepts, so the total
+    equals encoding the whole text at once. At most max_carry characters are
+    held between cuts; a run longer than that with no newline or space is cut
+    anyway, which can shift the count by a token. With a cap, counting stops
+    as soon as the total exceeds it and the partial (> cap) count is returned.
+    """
+    encoder = get_encoder(encoding_name)
+    if encoder is None:
+        chars = 0
+        for chunk in chunks:
+            with PROFILER.stage("tokenize", bytes=len(chunk)):
+                chars += len(chunk)
+            if cap is not None and chars // 4 > cap:
+                break
+        return chars // 4
+    
+    tokens = 0
+    carry = ""
+    for chunk in chunks:
+        search_from = max(0, len(carry) - 1)
+        carry += chunk
+        
+        # A newline cut can only appear in the new text or at the seam
+        cut = find_token_safe_cut(carry, search_from) if len(carry) <= max_carry else None
+        if cut is None and len(carry) > max_carry:
+            cut = find_token_safe_cut(carry) or max_carry
+        if cut is None:
+            continue
+        
+        tokens += estimate_tokens(carry[:cut], encoding_name)
+        carry = carry[cut:]
+        if cap is not None and tokens > cap:
+            return tokens
+    return tokens + estimate_tokens(carry, encoding_name)
+
+def stream_source_file(filepath, encoding_name="cl100k_base", chunk_size=1048576, cap=None,
+                       settings=None, use_mmap=True):
+    """Sniff, hash and count a large file chunk by chunk without holding it in memory
+    
+    Newlines are normalized as a text-mode read would, and the result records
+    whether the file had any carriage returns so the writer knows whether a
+    raw byte copy reproduces the text-mode output. Images are answered with
+    read_image_stub() from the first bytes, like read_source_file().
+    
+    The file is classified from its first bytes before anything else is
+    read, and only a file that is kept (clean text within the cap) is
+    hashed. With use_mmap the file is mapped rather than read: the
+    carriage-return check is one scan of the mapping, only chunk_size slices
+    are decoded at a time for the tokenizer, and a file without carriage
+    returns is hashed straight off the mapping instead of re-encoding the
+    decoded text.
+    """
+    has_cr = False
+    hash_chunks = True
+    bytes_read = 0
+    hasher = hashlib.blake2b(digest_size=16)
+    
+    def text_chunks(file_handle):
+        nonlocal bytes_read
+        while True:
+            chunk = file_handle.read(chunk_size)
+            if not chunk:
+                break
+            bytes_read += len(chunk)
+            yield chunk
+    
+    def mapped_chunks(buffer):
+        nonlocal bytes_read
+        decoder = codecs.getincrementaldecoder('utf-8')()
+        # Views are released as soon as they're done with; the mapping can't close while one is held
+        with memoryview(buffer) as view:
+            for start in range(0, len(view), chunk_size):
+                with view[start:start + chunk_size] as piece:
+                    chunk = decoder.decode(piece)
+                    bytes_read += len(piece)
+                if chunk:
+                    yield chunk
+        chunk = decoder.decode(b'', final=True)
+        if chunk:
+            yield chunk
+    
+    def normalized_chunks(chunks):
+        nonlocal has_cr
+        pending_cr = ""
+        for chunk in chunks:
+            chunk = pending_cr + chunk
+            pending_cr = ""
+            if chunk.endswith('\r'):
+                chunk, pending_cr = chunk[:-1], '\r'
+            if '\r' in chunk:
+                has_cr = True
+                chunk = chunk.replace('\r\n', '\n').replace('\r', '\n')
+            if hash_chunks:
+                hasher.update(chunk.encode('utf-8', 'surrogatepass'))
+            yield chunk
+        if pending_cr:
+            has_cr = True
+            hasher.update(b'\n')
+            yield '\n'
+    
+    try:
+        with PROFILER.stage("stream", files=1) as stage, open(filepath, 'rb') as binary_handle:
+            head = binary_handle.read(BINARY_SAMPLE_BYTES)
+            stub = read_image_stub(binary_handle, head)
+            if stub is not None:
+                return read_result(stub["content"], tokens=estimate_tokens(stub["content"], encoding_name),
+                                   image=stub["image"])
+            if is_binary_sample(head):
+                return read_result(verdict="binary", streamed=True)
+            # A multi-byte character cut off at the end of the sample is left undecoded
+            prefix = codecs.getincrementaldecoder('utf-8')().decode(head).replace('\r\n', '\n').replace('\r', '\n')
+            with PROFILER.stage("classify", files=1):
+                verdict = classify_content(filepath, prefix, settings)
+            if verdict is not None:
+                stage.add(bytes=len(head))
+                return read_result(verdict=verdict, streamed=True)
+            if use_mmap and os.fstat(binary_handle.fileno()).st_size > 0:
+                with mmap.mmap(binary_handle.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+                    # Without carriage returns the normalized text is the file's own bytes
+                    hash_chunks = buffer.find(b'\r') != -1
+                    source = mapped_chunks(buffer)
                     try:
-                        with open(item, 'r', encoding='utf-8') as f:
-                            content = f.read()
-                            tokens = estimate_tokens(content, config["token_config"]["encoding"])
-                            total_tokens += tokens
-                            file_count += 1
-                    except Exception:
-                        continue
-    except Exception:
-        pass
+                        tokens = count_stream_tokens(normalized_chunks(source), encoding_name, cap,
+                                                     max_carry=4 * chunk_size)
+                    finally:
+                        source.close()
+                    if not hash_chunks and (cap is None or tokens <= cap):
+                        hasher.update(buffer)
+            else:
+                binary_handle.seek(0)
+                file_handle = io.TextIOWrapper(binary_handle, encoding='utf-8', newline='')
+                tokens = count_stream_tokens(normalized_chunks(text_chunks(file_handle)), encoding_name, cap,
+                                             max_carry=4 * chunk_size)
+            stage.add(bytes=bytes_read)
+    except Exception as e:
+        return read_result(error=e, streamed=True)
     
-    return total_tokens, file_count
+    # Counting stopped at the cap, so the hash covers only part of the text
+    digest = hasher.hexdigest() if cap is None or tokens <= cap else None
+    return read_result(tokens=tokens, streamed=True, has_cr=has_cr, digest=digest)
+
+def read_large_file(filepath, encoding_name="cl100k_base", chunk_size=1048576, known_tokens=None,
+                    cap=None, settings=None, use_mmap=True):
+    """Read result for a file too large to hold
+    
+    A cached count means the file is unchanged since it was last classified
+    clean text (only included, non-image files are cached), so it isn't
+    opened at all.
+    """
+    if known_tokens is not None:
+        return read_result(tokens=known_tokens, streamed=True)
+    return stream_source_file(filepath, encoding_name, chunk_size, cap, settings, use_mmap)
+
+def copy_file_body(filepath, outfile, chunk_size=1048576, raw_ok=False, use_mmap=True):
+    """Stream a file's body into a text-mode output without decoding it
+    
+    Bytes are copied in chunk_size pieces with newlines translated the way a
+    text-mode read and write would. When the scan saw no carriage returns
+    (raw_ok) and the platform writes bare newlines, os.sendfile copies the
+    file in the kernel instead, or where that isn't available the file is
+    mapped and written straight from the mapping.
+    """
+    outfile.flush()
+    out_buffer = outfile.buffer
+    start = out_buffer.tell()
+    try:
+        output_stat = os.fstat(out_buffer.fileno())
+    except (AttributeError, OSError):
+        output_stat = None
+    
+    with open(filepath, 'rb') as infile:
+        # Copying a file into itself would keep reading back what was just written
+        if output_stat is not None and os.path.samestat(os.fstat(infile.fileno()), output_stat):
+            raise OSError(f"{filepath} is the output being written")
+        
+        # sendfile needs a real, seekable file; not e.g. a BackgroundCompressor
+        if raw_ok and os.linesep == '\n' and hasattr(os, 'sendfile') and out_buffer.seekable():
+            copied = 0
+            try:
+                while True:
+                    sent = os.sendfile(out_buffer.fileno(), infile.fileno(), copied, chunk_size)
+                    if sent == 0:
+                        break
+                    copied += sent
+                # Writes went behind the buffered writer's back - resync its position
+                out_buffer.seek(start + copied)
+                return
+            except OSError:
+                out_buffer.seek(start)
+        
+        size = os.fstat(infile.fileno()).st_size
+        if raw_ok and os.linesep == '\n' and use_mmap and size > 0:
+            with mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ) as buffer, memoryview(buffer) as view:
+                out_buffer.write(view)
+            return
+        
+        linesep = os.linesep.encode()
+        pending_cr = b""
+        while True:
+            chunk = infile.read(chunk_size)
+            if not chunk:
+                break
+            chunk = pending_cr + chunk
+            pending_cr = b""
+            if chunk.endswith(b'\r'):
+                chunk, pending_cr = chunk[:-1], b'\r'
+            chunk = chunk.replace(b'\r\n', b'\n').replace(b'\r', b'\n')
+            if linesep != b'\n':
+                chunk = chunk.replace(b'\n', linesep)
+            out_buffer.write(chunk)
+        if pending_cr:
+            out_buffer.write(linesep)
+
+def write_record_body(outfile, record, config, as_reference=False):
+    """Write a manifest record's content, streaming it from disk if it wasn't held in memory"""
+    with PROFILER.stage("write", files=1) as stage:
+        if as_reference:
+            outfile.write(record["dedup"]["body"])
+            stage.add(bytes=len(record["dedup"]["body"]))
+        elif record["streamed"]:
+            io_config = config.get("io", DEFAULT_CONFIG["io"])
+            chunk_size = io_config.get("chunk_bytes", 1048576)
+            if hasattr(outfile, "buffer"):
+                copy_file_body(record["path"], outfile, chunk_size,
+                               raw_ok=record["has_cr"] is False, use_mmap=io_config.get("mmap", True))
+            else:
+                # A pure text stream (e.g. io.StringIO) has no bytes to copy into
+                with open(record["path"], 'r', encoding='utf-8') as infile:
+                    for chunk in iter(lambda: infile.read(chunk_size), ''):
+                        outfile.write(chunk)
+            stage.add(bytes=record["stat"].st_size)
+        else:
+            outfile.write(record["content"])
+            stage.add(bytes=len(record["content"]))
+
+# Cache misses are tokenized together once this many files or characters have built up
+MISS_BATCH_FILES = 64
+MISS_BATCH_CHARS = 4194304
+
+def read_ahead(items, start, depth):
+    """Yield (item, start(item)) in order, with start already called on up to depth items further on
+    
+    start typically submits a read to a thread pool and returns its future,
+    so reads overlap whatever the consumer does with earlier items while the
+    window bounds how much is held in memory. depth 0 is a plain serial loop.
+    """
+    window = deque()
+    for item in items:
+        window.append((item, start(item)))
+        if len(window) > depth:
+            yield window.popleft()
+    while window:
+        yield window.popleft()
+
+def _init_scan_worker(encoding_name):
+    """Process-pool initializer: load the tokenizer once per worker"""
+    get_encoder(encoding_name)
+
+def _scan_worker(task):
+    """Process-pool task: read, sniff, transform and tokenize one file
+    
+    known_stages holds the cached count of each transform stage (None where
+    the cache had none); only the missing stages are tokenized.
+    """
+    (filepath, encoding_name, known_stages, streamed, chunk_size, cap, settings,
+     transform_names, transform_settings, use_mmap) = task
+    if streamed:
+        return read_large_file(filepath, encoding_name, chunk_size, known_stages[0], cap, settings, use_mmap)
+    
+    result = read_source_file(filepath, settings)
+    if result["content"] is not None:
+        steps = [(name, TRANSFORMS[name]) for name in transform_names]
+        texts = transform_stages(result["content"], steps, transform_settings,
+                                 filepath.suffix.lower().lstrip('.'))
+        missing = [index for index, tokens in enumerate(known_stages) if tokens is None]
+        stage_tokens = list(known_stages)
+        last = len(texts) - 1
+        intermediate = [index for index in missing if index < last]
+        for index, tokens in zip(intermediate, estimate_tokens_batch([texts[index] for index in intermediate],
+                                                                     encoding_name)):
+            stage_tokens[index] = tokens
+        # Only the final count decides the cap, so only it may stop early
+        if stage_tokens[last] is None:
+            stage_tokens[last] = estimate_tokens_capped(texts[last], encoding_name, cap)
+        result["content"] = texts[-1]
+        result["tokens"] = stage_tokens[-1]
+        result["stage_tokens"] = stage_tokens
+        result["stage_digests"] = {index: content_hash(texts[index]) for index in missing}
+    return result
+
+def apply_read_result(record, result, cap=None):
+    """Fill a manifest record from the outcome of reading its file"""
+    record["streamed"] = result["streamed"]
+    record["has_cr"] = result["has_cr"]
+    record["image"] = result["image"]
+    record["digest"] = result["digest"]
+    if result["error"] is not None:
+        record["status"] = "error"
+        record["error"] = result["error"]
+    elif result["verdict"] is not None:
+        record["minified"] = result["verdict"] == "minified"
+        record["status"] = result["verdict"]
+    else:
+        record["content"] = result["content"]
+        record["tokens"] = result["tokens"] or 0
+        apply_token_cap(record, cap)
+
+def apply_token_cap(record, cap):
+    """Mark an included record that exceeds the per-file token cap as skipped"""
+    if cap is not None and record["status"] == "included" and record["tokens"] > cap:
+        record["status"] = "over_cap"
+        record["content"] = None
+
+# Comments and quoted strings in C-family sources; strings are matched so comment markers inside them survive
+C_STRING_OR_COMMENT = re.compile(
+    r'("(?:\\.|[^"\\\n])*"|\'(?:\\.|[^\'\\\n])*\'|`(?:\\.|[^`\\])*`)|/\*.*?\*/|//[^\n]*',
+    re.DOTALL
+)
+CSS_STRING_OR_COMMENT = re.compile(
+    r'("(?:\\.|[^"\\\n])*"|\'(?:\\.|[^\'\\\n])*\')|/\*.*?\*/',
+    re.DOTALL
+)
+C_COMMENT_EXTENSIONS = frozenset(["js", "mjs", "cjs", "jsx", "ts", "tsx", "vue", "scss", "less", "php", "gd"])
+CSS_COMMENT_EXTENSIONS = frozenset(["css"])
+
+def drop_marked_lines(text, marker='\x00'):
+    """Replace comment markers with a space; lines left blank by a removed comment go entirely"""
+    lines = []
+    for line in text.split('\n'):
+        if marker in line:
+            line = line.replace(marker, ' ').rstrip()
+            if not line.strip():
+                continue
+        lines.append(line)
+    return '\n'.join(lines)
+
+def strip_comments(text, suffix, settings):
+    """Remove comments: # comments in Python (via tokenize), /* */ and // elsewhere
+    
+    Lines that held only a comment are dropped; blank lines that were already
+    there are left for collapse_blank_lines. Python that doesn't tokenize and
+    unknown extensions are returned unchanged. Other languages go through a
+    regex that knows quoted strings but not JS regex literals, so a literal
+    like /[/*]/ is cut as if it opened a comment.
+    """
+    if suffix == "py":
+        try:
+            comments = {
+                token.start[0] - 1: token.start[1]
+                for token in tokenize.generate_tokens(io.StringIO(text).readline)
+                if token.type == tokenize.COMMENT
+            }
+        except (tokenize.TokenError, SyntaxError):
+            return text
+        lines = []
+        for index, line in enumerate(text.split('\n')):
+            if index in comments:
+                line = line[:comments[index]].rstrip()
+                if not line.strip():
+                    continue
+            lines.append(line)
+        return '\n'.join(lines)
+    
+    if suffix in C_COMMENT_EXTENSIONS:
+        pattern = C_STRING_OR_COMMENT
+    elif suffix in CSS_COMMENT_EXTENSIONS:
+        pattern = CSS_STRING_OR_COMMENT
+    else:
+        return text
+    return drop_marked_lines(pattern.sub(lambda match: match.group(1) or '\x00', text))
+
+def collapse_blank_lines(text, suffix, settings):
+    """Strip trailing whitespace and squeeze runs of blank lines down to one"""
+    text = re.sub(r'[ \t]+$', '', text, flags=re.MULTILINE)
+    return re.sub(r'\n{3,}', '\n\n', text)
+
+def compact_json(text, suffix, settings):
+    """Re-serialize JSON without indentation or spaces; text that doesn't parse is left alone"""
+    try:
+        return json.dumps(json.loads(text), ensure_ascii=False, separators=(',', ':'))
+    except ValueError:
+        return text
 
-def generate_file_tree(output_file, mode, config, minutes_ago=None):
-    """Generate a tree structure of included files with token counts"""
-    current_dir = Path.cwd()
+def collapse_literals(text, suffix, settings):
+    """Shorten quoted strings and number arrays longer than literal_max_chars to a short preview"""
+    limit = settings.get("literal_max_chars", 200)
+    
+    def shorten_string(match):
+        quote, body = match.group(0)[0], match.group(0)[1:-1]
+        return f"{quote}{body[:32].rstrip(chr(92))}...({len(body):,} chars){quote}"
+    
+    def shorten_numbers(match):
+        items = [item.strip() for item in match.group(0)[1:-1].split(',')]
+        return f"[{', '.join(items[:3])}, ...({len(items):,} numbers)]"
+    
+    text = re.sub(r'"(?:\\.|[^"\\\n]){%d,}"|\'(?:\\.|[^\'\\\n]){%d,}\'' % (limit, limit),
+                  shorten_string, text)
+    return re.sub(r'\[(?=[^\]]*\d)[-+\d\s,.eExXa-fA-F]{%d,}\]' % limit, shorten_numbers, text)
+
+# Transforms by the names used in transforms.by_extension; each takes (text, extension, settings)
+TRANSFORMS = {
+    "strip_comments": strip_comments,
+    "collapse_blank_lines": collapse_blank_lines,
+    "compact_json": compact_json,
+    "collapse_literals": collapse_literals,
+}
+
+def resolve_transforms(config, log=print):
+    """Map each configured extension to its list of (name, transform); unknown names are reported and dropped"""
+    settings = config.get("transforms", DEFAULT_CONFIG["transforms"])
+    steps = {}
+    for extension, names in settings.get("by_extension", {}).items():
+        for name in names:
+            if name not in TRANSFORMS:
+                log(f"Unknown transform '{name}' for .{extension} files - ignored")
+        known = [(name, TRANSFORMS[name]) for name in names if name in TRANSFORMS]
+        if known:
+            steps[extension.lower().lstrip('.')] = known
+    return steps
+
+# Bump whenever a transform's output changes, so cached counts of transformed text are retired
+TRANSFORMS_VERSION = 1
+
+def transform_stage_keys(encoding_key, steps, settings=None):
+    """Token-cache keys for a file's text before and after each transform step
+    
+    Keys of transformed stages include a fingerprint of the transform
+    settings (literal_max_chars and so on) and TRANSFORMS_VERSION, since a
+    size/mtime hit is trusted without looking at the transformed text.
+    """
+    if not steps:
+        return [encoding_key]
+    if settings is None:
+        settings = DEFAULT_CONFIG["transforms"]
+    options = {key: value for key, value in settings.items() if key != "by_extension"}
+    fingerprint = hashlib.blake2b(json.dumps([TRANSFORMS_VERSION, options], sort_keys=True).encode(),
+                                  digest_size=4).hexdigest()
+    names = [name for name, _ in steps]
+    return [encoding_key] + [f"{encoding_key}|{fingerprint}|{'+'.join(names[:index])}"
+                             for index in range(1, len(names) + 1)]
+
+def transform_stages(content, steps, settings, suffix):
+    """A file's text before and after each transform step"""
+    texts = [content]
+    for _, transform in steps:
+        texts.append(transform(texts[-1], suffix, settings))
+    return texts
+
+def transform_savings(steps, stage_tokens):
+    """Tokens each transform step saved, from the counts before and after each step"""
+    return {name: stage_tokens[index] - stage_tokens[index + 1] for index, (name, _) in enumerate(steps)}
+
+def shingle_sketch(text, shingle_words=5, sketch_size=128):
+    """Bottom-k MinHash sketch of a text's word shingles: its sketch_size smallest shingle hashes"""
+    words = text.split()
+    shingles = {
+        zlib.crc32(" ".join(words[index:index + shingle_words]).encode('utf-8', 'surrogatepass'))
+        for index in range(max(1, len(words) - shingle_words + 1))
+    }
+    return heapq.nsmallest(sketch_size, shingles)
+
+def sketch_similarity(sketch_a, sketch_b, sketch_size=128):
+    """Estimate the Jaccard similarity of two texts from their bottom-k sketches"""
+    set_a, set_b = set(sketch_a), set(sketch_b)
+    union = heapq.nsmallest(sketch_size, set_a | set_b)
+    if not union:
+        return 0.0
+    return sum(1 for value in union if value in set_a and value in set_b) / len(union)
+
+def dedupe_records(records, config, encoding_name="cl100k_base"):
+    """Turn repeated content into references to its first occurrence, in walk order
+    
+    Included files with the same content hash after the first get a dedup
+    entry whose body is "identical to FILE: x". With dedup.near_duplicates,
+    in-memory files whose shingle sketch is close enough to an earlier one's
+    get a unified diff against the most similar of them instead; candidates
+    come from an inverted index over sketch values, so files are never
+    compared pairwise. A reference is only kept when it costs fewer tokens
+    than the file, and record["tokens"] becomes its cost; the full count is
+    kept in dedup["full_tokens"] for when the original isn't written.
+    Image stubs are never deduplicated.
+    """
+    settings = config.get("dedup", DEFAULT_CONFIG["dedup"])
+    for record in records:
+        if record.get("dedup") is not None:
+            record["tokens"] = record["dedup"]["full_tokens"]
+            record["dedup"] = None
+    if not settings.get("enabled", True):
+        return
+    
+    near_duplicates = settings.get("near_duplicates", False)
+    threshold = settings.get("similarity_threshold", 0.8)
+    shingle_words = settings.get("shingle_words", 5)
+    sketch_size = settings.get("sketch_size", 128)
+    first_by_digest = {}
+    sketches = []  # (record, sketch) of files written in full, candidates for diffs
+    sketch_index = {}  # Sketch value -> positions in sketches
+    
+    for record in records:
+        # An image stub's fingerprint only samples the file, so it can't prove two images identical
+        if record["status"] != "included" or record["image"] is not None:
+            continue
+        if record["digest"] is None and record["content"] is not None:
+            record["digest"] = content_hash(record["content"])
+        
+        original = first_by_digest.setdefault(record["digest"], record) if record["digest"] else record
+        if original is not record:
+            body = f"identical to FILE: {original['relative_path']}"
+            tokens = estimate_tokens(body, encoding_name)
+            if tokens < record["tokens"]:
+                record["dedup"] = {"kind": "identical", "original": original, "body": body,
+                                   "full_tokens": record["tokens"]}
+                record["tokens"] = tokens
+            continue
+        
+        if not near_duplicates or record["content"] is None:
+            continue
+        
+        sketch = shingle_sketch(record["content"], shingle_words, sketch_size)
+        shared = {}
+        for value in sketch:
+            for position in sketch_index.get(value, ()):
+                shared[position] = shared.get(position, 0) + 1
+        
+        best, best_similarity = None, threshold
+        for position, count in shared.items():
+            # Too few shared values to reach the threshold, whatever the union
+            if count < threshold * len(sketch) / 2:
+                continue
+            similarity = sketch_similarity(sketch, sketches[position][1], sketch_size)
+            if similarity >= best_similarity:
+                best, best_similarity = sketches[position][0], similarity
+        
+        if best is not None:
+            diff = difflib.unified_diff(
+                best["content"].splitlines(), record["content"].splitlines(),
+                str(best["relative_path"]), str(record["relative_path"]), lineterm=""
+            )
+            body = f"near-duplicate of FILE: {best['relative_path']} (unified diff)\n" + "\n".join(diff)
+            tokens = estimate_tokens(body, encoding_name)
+            if tokens < record["tokens"]:
+                record["dedup"] = {"kind": "diff", "original": best, "body": body,
+                                   "full_tokens": record["tokens"]}
+                record["tokens"] = tokens
+                continue
+        
+        for value in sketch:
+            sketch_index.setdefault(value, []).append(len(sketches))
+        sketches.append((record, sketch))
+
+@profiled("scan_files")
+def scan_files(mode, config, minutes_ago=None, current_dir=None, cache=None, jobs=1, previous=None,
+               since=None, log=print, outputs=()):
+    """Walk the tree once into the manifest that the tree and concatenation both render from
+    
+    Records carry stat, content (None when streamed), tokens and a status.
+    previous: manifest whose unchanged records are reused; since: git
+    revision to diff against; outputs: paths this run writes, never read as
+    sources; log: receives notices.
+    """
+    if current_dir is None:
+        current_dir = Path.cwd()
     root_name = current_dir.name
+    matcher = PathMatcher(config, root_name)
+    encoding_name = config["token_config"]["encoding"]
+    get_encoder(encoding_name, log)
+    encoding_key = token_counter_key(encoding_name)
+    io_config = config.get("io", DEFAULT_CONFIG["io"])
+    stream_threshold = io_config.get("stream_threshold_bytes", 1048576)
+    chunk_size = io_config.get("chunk_bytes", 1048576)
+    walk_threads = io_config.get("walk_threads", 0)
+    use_mmap = io_config.get("mmap", True)
+    cap = config["token_config"].get("file_token_cap")
+    classifier = config.get("classifier", DEFAULT_CONFIG["classifier"])
+    transform_settings = config.get("transforms", DEFAULT_CONFIG["transforms"])
+    transform_steps = resolve_transforms(config, log)
+    output_stats = []
+    for output in outputs:
+        try:
+            output_stats.append(os.stat(output))
+        except OSError:
+            pass
+    git_files = None
+    if since is not None or io_config.get("enumerate", "walk") == "git":
+        try:
+            with PROFILER.stage("git_index"):
+                git_files = git_index_files(current_dir, since)
+        except RuntimeError as e:
+            if since is not None:
+                raise
+            log(f"Not enumerating from git ({e}); walking the tree instead")
+    if git_files is not None:
+        walker = walk_git_index(current_dir, git_files)
+    else:
+        walker = walk_tree(current_dir, walk_threads)
+    directories = []
+    pending = []  # Records that still need their file read, in walk order
+    reusable = {}
+    if previous is not None:
+        for directory in previous["directories"]:
+            for record in directory["files"]:
+                if record["stat"] is not None:
+                    reusable[record["path"]] = record
+    
+    for root, dir_entries, file_entries in PROFILER.iterate("walk", walker):
+        root_path = Path(root)
+        relative_root = root_path.relative_to(current_dir)
+        relative_dir = relative_root.as_posix() if relative_root.parts else ""
+        prefix = relative_dir + "/" if relative_dir else ""
+        
+        matcher.enter_directory(root, relative_dir, [entry.name for entry in file_entries])
+        dir_entries[:] = [entry for entry in dir_entries
+                          if not matcher.ignores_dir(entry.name, prefix + entry.name)]
+        records = []
+        
+        for entry in file_entries:
+            f = entry.name
+            relative_file = prefix + f
+            if not matcher.includes_file(f, relative_file, mode):
+                continue
+            
+            filepath = root_path / f
+            record = {
+                "name": f,
+                "path": filepath,
+                "relative_path": filepath.relative_to(current_dir),
+                "stat": None,
+                "content": None,
+                "minified": False,
+                "tokens": 0,
+                "status": "included",
+                "error": None,
+                "streamed": False,  # Content left on disk; written by streaming
+                "has_cr": None,
+                "image": None,  # Metadata description when content is an image stub
+                "digest": None,  # content_hash of the text, when known
+                "dedup": None,  # Reference to an earlier copy; see dedupe_records()
+                "transform_savings": None,  # Tokens saved by each transform applied to content
+                "blob": git_files.get(relative_file) if git_files is not None else None,  # Git index hash
+            }
+            records.append(record)
+            
+            if matcher.ignores_file(f, relative_file):
+                record["status"] = "ignored"
+                continue
+            
+            # Filename patterns are enough to skip some minified files unread
+            if has_minified_name(filepath):
+                record["minified"] = True
+                record["status"] = "minified"
+                continue
+            
+            try:
+                with PROFILER.stage("stat", files=1):
+                    record["stat"] = entry.stat()
+            except OSError:
+                pass
+            
+            if record["stat"] is not None and any(os.path.samestat(record["stat"], output)
+                                                  for output in output_stats):
+                record["status"] = "ignored"
+                continue
+            
+            if not is_recently_modified(filepath, minutes_ago, record["stat"]):
+                record["status"] = "time_filtered"
+                continue
+            
+            old = reusable.get(filepath)
+            if (old is not None and record["stat"] is not None
+                    and old["status"] in ("included", "minified", "generated", "binary", "error", "over_cap")
+                    and old["stat"].st_size == record["stat"].st_size
+                    and old["stat"].st_mtime_ns == record["stat"].st_mtime_ns):
+                for key in ("content", "minified", "tokens", "status", "error", "streamed", "has_cr",
+                            "image", "digest", "transform_savings"):
+                    record[key] = old[key]
+                if old["dedup"] is not None:
+                    record["tokens"] = old["dedup"]["full_tokens"]
+                continue
+            
+            pending.append(record)
+        
+        directories.append({
+            "path": root_path,
+            "relative_path": relative_root,
+            "depth": len(relative_root.parts),
+            "files": records,
+        })
+    
+    def is_large(record):
+        return record["stat"] is not None and record["stat"].st_size >= stream_threshold
+    
+    def cached_tokens(record, content=None, key=encoding_key):
+        if cache is None or record["stat"] is None:
+            return None, None
+        with PROFILER.stage("token_cache"):
+            return cache.lookup(record["path"], record["stat"], key, content)
+    
+    def store_tokens(record, tokens, content, digest, key=encoding_key):
+        # Image stubs are cheap to rebuild, and a cached count must never stand in for one
+        if (cache is not None and record["stat"] is not None and record["status"] == "included"
+                and record["image"] is None):
+            cache.store(record["path"], record["stat"], key, content, tokens, digest)
+    
+    def record_steps(record):
+        # Streamed files are never held in memory, so they can't be transformed
+        if is_large(record):
+            return []
+        return transform_steps.get(record["path"].suffix.lower().lstrip('.'), [])
+    
+    def finish_stages(record, steps, stage_tokens):
+        record["tokens"] = stage_tokens[-1]
+        apply_token_cap(record, cap)
+        if steps and record["status"] == "included":
+            record["transform_savings"] = transform_savings(steps, stage_tokens)
+    
+    if jobs > 1 and len(pending) > 1:
+        tasks = []
+        known_digests = []
+        for record in pending:
+            steps = record_steps(record)
+            keys = transform_stage_keys(encoding_key, steps, transform_settings)
+            known = [cached_tokens(record, key=key) for key in keys]
+            known_digests.append(known[-1][1])
+            tasks.append((record["path"], encoding_name, [tokens for tokens, _ in known], is_large(record),
+                          chunk_size, cap, classifier, [name for name, _ in steps], transform_settings,
+                          use_mmap))
+        
+        chunksize = max(1, len(tasks) // (jobs * 8))
+        with PROFILER.stage("worker_pool", files=len(tasks)), \
+                ProcessPoolExecutor(max_workers=jobs, initializer=_init_scan_worker,
+                                    initargs=(encoding_name,)) as executor:
+            results = executor.map(_scan_worker, tasks, chunksize=chunksize)
+            for record, task, result, digest in zip(pending, tasks, results, known_digests):
+                apply_read_result(record, result, cap)
+                steps = record_steps(record)
+                keys = transform_stage_keys(encoding_key, steps, transform_settings)
+                if result["stage_tokens"] is None:
+                    if task[2][0] is None:
+                        store_tokens(record, record["tokens"], record["content"], result["digest"])
+                else:
+                    for index, stage_digest in result["stage_digests"].items():
+                        store_tokens(record, result["stage_tokens"][index], None, stage_digest, keys[index])
+                    digest = result["stage_digests"].get(len(keys) - 1, digest)
+                    if steps and record["status"] == "included":
+                        record["transform_savings"] = transform_savings(steps, result["stage_tokens"])
+                if record["digest"] is None:
+                    record["digest"] = digest
+    else:
+        read_threads = io_config.get("read_threads", 4)
+        executor = ThreadPoolExecutor(max_workers=read_threads) if read_threads > 0 and len(pending) > 1 else None
+        
+        def start_read(record):
+            # Cache lookups stay on this thread: the sqlite connection isn't shared
+            known = cached_tokens(record) if is_large(record) else (None, None)
+            if is_large(record):
+                call = (read_large_file, record["path"], encoding_name, chunk_size, known[0], cap, classifier,
+                        use_mmap)
+            else:
+                call = (read_source_file, record["path"], classifier)
+            if executor is None:
+                return known, call[0](*call[1:])
+            return known, executor.submit(*call)
+        
+        misses = []
+        miss_chars = 0
+        
+        def tokenize_misses():
+            # Counts what the cache couldn't answer; called every MISS_BATCH_* so encoding
+            # runs while the reads queued behind it are still in flight
+            nonlocal misses, miss_chars
+            counts = estimate_tokens_batch([miss[0]["content"] for miss in misses], encoding_name, cap=cap, log=log)
+            for (record, digest, key, steps, stage_tokens), tokens in zip(misses, counts):
+                stage_tokens[-1] = tokens
+                content = record["content"]
+                # The cap is applied first: a count that stopped early must not be cached
+                finish_stages(record, steps, stage_tokens)
+                store_tokens(record, tokens, content, digest, key)
+            misses = []
+            miss_chars = 0
+        
+        try:
+            for record, (known, result) in read_ahead(pending, start_read, read_threads * 2 if executor else 0):
+                if executor is not None:
+                    with PROFILER.stage("read_wait"):
+                        result = result.result()
+                if is_large(record):
+                    known_tokens, digest = known
+                    apply_read_result(record, result, cap)
+                    if known_tokens is None:
+                        store_tokens(record, record["tokens"], None, result["digest"])
+                    elif record["digest"] is None:
+                        record["digest"] = digest
+                    continue
+                
+                apply_read_result(record, result)
+                if record["content"] is None:
+                    continue
+                
+                steps = record_steps(record)
+                keys = transform_stage_keys(encoding_key, steps, transform_settings)
+                with PROFILER.stage("transform", files=1 if steps else 0):
+                    texts = transform_stages(record["content"], steps, transform_settings,
+                                             record["path"].suffix.lower().lstrip('.'))
+                record["content"] = texts[-1]
+                stage_tokens = []
+                stage_misses = []
+                for index, (key, text) in enumerate(zip(keys, texts)):
+                    tokens, digest = cached_tokens(record, text, key)
+                    stage_tokens.append(tokens)
+                    if tokens is None and index < len(texts) - 1:
+                        stage_misses.append((index, digest))
+                record["digest"] = digest
+                
+                # Intermediate stages are counted right away so their texts can be dropped
+                counts = estimate_tokens_batch([texts[index] for index, _ in stage_misses], encoding_name, log=log)
+                for (index, stage_digest), tokens in zip(stage_misses, counts):
+                    stage_tokens[index] = tokens
+                    store_tokens(record, tokens, texts[index], stage_digest, keys[index])
+                
+                if stage_tokens[-1] is None:
+                    misses.append((record, digest, keys[-1], steps, stage_tokens))
+                    miss_chars += len(record["content"])
+                    if len(misses) >= MISS_BATCH_FILES or miss_chars >= MISS_BATCH_CHARS:
+                        tokenize_misses()
+                else:
+                    finish_stages(record, steps, stage_tokens)
+            tokenize_misses()
+        finally:
+            if executor is not None:
+                executor.shutdown(wait=False, cancel_futures=True)
+    
+    with PROFILER.stage("dedup"):
+        dedupe_records([record for directory in directories for record in directory["files"]],
+                       config, encoding_name)
+    
+    return {
+        "root": current_dir,
+        "mode": mode,
+        "matcher": matcher,
+        "minutes_ago": minutes_ago,
+        "since": since,
+        "git": git_files is not None,
+        "directories": directories,
+        "files_read": len(pending),
+    }
+
+def record_flags(record):
+    """Attributes of a file record worth knowing beyond its status, for the manifest"""
+    flags = []
+    if record["streamed"]:
+        flags.append("streamed")
+    if record["image"] is not None:
+        flags.append("image")
+    if record["dedup"] is not None:
+        flags.append("duplicate" if record["dedup"]["kind"] == "identical" else "near_duplicate")
+    if record["transform_savings"]:
+        flags.append("transformed")
+    if record["has_cr"]:
+        flags.append("crlf")
+    return flags
+
+@profiled("write_manifest")
+def write_manifest(output_file, manifest, config):
+    """Write the scan manifest as NDJSON, one line at a time
+    
+    The first line describes the snapshot; then each directory's file lines
+    (path, size, mtime, tokens, status, flags, hash and, where they apply,
+    the duplicate it refers to and per-transform savings) are followed by a
+    directory line with its included file count and tokens; a summary line
+    closes the file. Directory lines carry subtree totals as well. Nothing is
+    re-read: every value comes from the manifest.
+    """
+    matcher = manifest["matcher"]
+    aggregates = aggregate_directories(manifest)
+    total_tokens = 0
+    total_files = 0
+    
+    with open_output(output_file, config) as out:
+        def emit(entry):
+            out.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        
+        emit({
+            "type": "snapshot",
+            "root": manifest["root"].name,
+            "mode": manifest["mode"],
+            "minutes": manifest["minutes_ago"],
+            "since": manifest["since"],
+            "source": "git" if manifest["git"] else "walk",
+            "generated": datetime.now().isoformat(timespec='seconds'),
+            "encoding": config["token_config"]["encoding"],
+            "tiktoken": TIKTOKEN_AVAILABLE,
+        })
+        
+        for directory in manifest["directories"]:
+            dir_tokens = 0
+            dir_files = 0
+            for record in directory["files"]:
+                stat_result = record["stat"]
+                relative_path = record["relative_path"].as_posix()
+                entry = {
+                    "type": "file",
+                    "path": relative_path,
+                    "size": stat_result.st_size if stat_result is not None else None,
+                    "mtime": stat_result.st_mtime if stat_result is not None else None,
+                    "tokens": record["tokens"],
+                    "status": record["status"],
+                    "flags": record_flags(record),
+                    "hash": record["digest"],
+                    "backend": matcher.is_backend(relative_path),
+                }
+                if record["blob"] is not None:
+                    entry["blob"] = record["blob"]
+                if record["dedup"] is not None:
+                    entry["duplicate_of"] = record["dedup"]["original"]["relative_path"].as_posix()
+                    entry["full_tokens"] = record["dedup"]["full_tokens"]
+                if record["transform_savings"]:
+                    entry["transform_savings"] = record["transform_savings"]
+                if record["error"] is not None:
+                    entry["error"] = str(record["error"])
+                emit(entry)
+                
+                if record["status"] == "included":
+                    dir_tokens += record["tokens"]
+                    dir_files += 1
+            
+            totals = aggregates[directory["relative_path"]]
+            emit({
+                "type": "directory",
+                "path": directory["relative_path"].as_posix(),
+                "depth": directory["depth"],
+                "files": dir_files,
+                "tokens": dir_tokens,
+                "subtree_files": totals["subtree_files"],
+                "subtree_tokens": totals["subtree_tokens"],
+                "candidates": len(directory["files"]),
+            })
+            total_tokens += dir_tokens
+            total_files += dir_files
+        
+        emit({
+            "type": "summary",
+            "files": total_files,
+            "tokens": total_tokens,
+            "status": get_threshold_status(total_tokens, config),
+        })
+
+def calculate_directory_tokens(directory):
+    """Calculate total tokens for the included files of a manifest directory"""
+    total_tokens = 0
+    file_count = 0
+    
+    for record in directory["files"]:
+        if record["status"] == "included":
+            total_tokens += record["tokens"]
+            file_count += 1
+    
+    return total_tokens, file_count
+
+def record_note(record, config):
+    """Why a file's token count isn't that of its full text, for the tree; None if it is"""
+    if record["dedup"] is not None:
+        relation = "identical to" if record["dedup"]["kind"] == "identical" else "diff against"
+        return f"{relation} {record['dedup']['original']['relative_path']}"
+    if record["image"] is not None:
+        # Only the metadata stub is concatenated for images
+        return f"{record['image']} image stub"
+    saved = sum((record["transform_savings"] or {}).values())
+    if saved:
+        return f"{saved:,} saved by transforms"
+    return None
+
+def aggregate_directories(manifest):
+    """Direct and recursive token/file totals for every manifest directory, in one pass
+    
+    Directories are in walk (pre-order) order, so walking them backwards
+    visits every child before its parent; each directory's subtree totals
+    are added to its parent's as it is passed. Returns a dict keyed by
+    relative path with tokens/files (direct) and subtree_tokens/subtree_files.
+    """
+    aggregates = {}
+    for directory in manifest["directories"]:
+        tokens, files = calculate_directory_tokens(directory)
+        aggregates[directory["relative_path"]] = {
+            "tokens": tokens, "files": files, "subtree_tokens": tokens, "subtree_files": files,
+        }
+    
+    for directory in reversed(manifest["directories"]):
+        if directory["depth"] == 0:
+            continue
+        totals = aggregates[directory["relative_path"]]
+        parent = aggregates.get(directory["relative_path"].parent)
+        if parent is not None:
+            parent["subtree_tokens"] += totals["subtree_tokens"]
+            parent["subtree_files"] += totals["subtree_files"]
+    return aggregates
+
+@profiled("generate_file_tree")
+def generate_file_tree(output_file, mode, config, minutes_ago=None, manifest=None, cache=None, log=print):
+    """Generate a tree structure of included files with token counts
+    
+    output_file may be a path or an open text stream; progress goes through log.
+    """
+    if manifest is None:
+        manifest = scan_files(mode, config, minutes_ago, cache=cache, log=log)
+    current_dir = manifest["root"]
     total_tokens = 0
     total_files = 0
+    savings = {}
     
-    print(f"\nGenerating {mode} file tree with token analysis...")
+    log(f"\nGenerating {mode} file tree with token analysis...")
     
-    with open(output_file, 'w', encoding='utf-8') as treefile:
+    with open_output(output_file, config) as treefile:
         treefile.write(f"{mode.title()} File Tree for '{current_dir.name}' - Generated {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n")
         treefile.write(f"Mode: {mode}\n")
         if minutes_ago:
             treefile.write(f"Time filter: Files modified in last {minutes_ago} minutes\n")
+        if manifest["since"]:
+            treefile.write(f"Changed since: {manifest['since']}\n")
         treefile.write(f"Tiktoken available: {TIKTOKEN_AVAILABLE}\n")
         treefile.write(f"Encoding: {config['token_config']['encoding']}\n")
         treefile.write("=" * 50 + "\n\n")
         
-        for root, dirs, files in os.walk(current_dir):
-            dirs[:] = [d for d in dirs if not should_ignore_dir(d, config)]
+        aggregates = aggregate_directories(manifest)
+        for directory in manifest["directories"]:
+            relative_root = directory["relative_path"]
+            depth = directory["depth"]
             
-            relative_root = Path(root).relative_to(current_dir)
-            depth = len(relative_root.parts)
+            # Direct totals, plus the whole subtree's when subdirectories add to it
+            totals = aggregates[relative_root]
+            dir_tokens, dir_file_count = totals["tokens"], totals["files"]
             
-            # Calculate directory token total
-            dir_tokens, dir_file_count = calculate_directory_tokens(Path(root), current_dir, mode, config, minutes_ago)
-            
-            if depth > 0 and (dir_tokens > 0 or any(f for f in files if should_include_file(Path(root) / f, current_dir, mode, config))):
+            if depth > 0 and (dir_tokens > 0 or directory["files"] or totals["subtree_files"]):
                 status_icon = "🔥" if dir_tokens >= config["token_config"]["file_warning_threshold"] else ("⚠️" if dir_tokens >= config["token_config"]["file_caution_threshold"] else "✅")
                 formatted_tokens = format_token_count(dir_tokens, config)
-                treefile.write("│   " * (depth-1) + f"├── {relative_root.parts[-1]}/ {status_icon} [{formatted_tokens} tokens, {dir_file_count} files]\n")
+                subtree = ""
+                if totals["subtree_files"] != dir_file_count:
+                    subtree = f" | subtree {format_token_count(totals['subtree_tokens'], config)} tokens, {totals['subtree_files']} files"
+                treefile.write("│   " * (depth-1) + f"├── {relative_root.parts[-1]}/ {status_icon} [{formatted_tokens} tokens, {dir_file_count} files{subtree}]\n")
             
-            # Filter for included files based on mode
+            # Files that passed every filter; unreadable ones are listed with 0 tokens
             included_files = []
-            for f in files:
-                filepath = Path(root) / f
-                if (should_include_file(filepath, current_dir, mode, config) and 
-                    not should_ignore_file(f, root_name, config) and 
-                    not is_minified(filepath) and
-                    is_recently_modified(filepath, minutes_ago)):
-                    
-                    try:
-                        with open(filepath, 'r', encoding='utf-8') as file_handle:
-                            content = file_handle.read()
-                            tokens = estimate_tokens(content, config["token_config"]["encoding"])
-                            included_files.append((f, tokens))
-                            total_tokens += tokens
-                            total_files += 1
-                    except Exception:
-                        included_files.append((f, 0))
+            for record in directory["files"]:
+                if record["status"] == "included":
+                    included_files.append((record["name"], record["tokens"], record_note(record, config)))
+                    total_tokens += record["tokens"]
+                    total_files += 1
+                    for name, saved in (record["transform_savings"] or {}).items():
+                        savings[name] = savings.get(name, 0) + saved
+                elif record["status"] == "error":
+                    included_files.append((record["name"], 0, None))
+                elif record["status"] == "over_cap":
+                    # Counting stopped at the cap, so only a lower bound is known
+                    included_files.append((record["name"], None, None))
             
-            included_files.sort()
+            included_files.sort(key=lambda item: item[0])
             
-            for filename, tokens in included_files:
+            for filename, tokens, note in included_files:
+                if tokens is None:
+                    cap = config["token_config"]["file_token_cap"]
+                    treefile.write("│   " * depth + f"├── {filename} 🔥[>{format_token_count(cap, config)} tokens, over file cap - skipped]\n")
+                    continue
                 warning_icon = get_file_warning_icon(tokens, config)
                 formatted_tokens = format_token_count(tokens, config)
+                if note is not None:
+                    treefile.write("│   " * depth + f"├── {filename} {warning_icon}[{formatted_tokens} tokens, {note}]\n")
+                    continue
                 treefile.write("│   " * depth + f"├── {filename} {warning_icon}[{formatted_tokens} tokens]\n")
         
         # Summary
@@ -396,141 +2496,798 @@ def generate_file_tree(output_file, mode, config, minutes_ago=None):
         treefile.write(f"Total files: {total_files}\n")
         total_formatted = format_token_count(total_tokens, config)
         treefile.write(f"Total tokens: {total_formatted}\n")
+        if savings:
+            treefile.write(f"Tokens saved by transforms: {sum(savings.values()):,}\n")
+            for name, saved in savings.items():
+                treefile.write(f"  {name}: {saved:,}\n")
         status = get_threshold_status(total_tokens, config)
         treefile.write(f"Status: {status.upper()}\n")
         treefile.write(f"Red threshold: {config['token_config']['red_threshold']:,}\n")
         treefile.write(f"Yellow threshold: {config['token_config']['yellow_threshold']:,}\n")
     
-    print(f"File tree complete! Total: {format_token_count(total_tokens, config)} tokens across {total_files} files")
+    log(f"File tree complete! Total: {format_token_count(total_tokens, config)} tokens across {total_files} files")
     return total_tokens, total_files
 
-def concatenate_files(output_file, mode, config, minutes_ago=None):
-    """Concatenate all included files into a single file with token management"""
-    current_dir = Path.cwd()
-    root_name = current_dir.name
+# Per-file header written before each file's content in the concatenated output
+FILE_HEADER_RULE = "=" * 50
+FILE_HEADER_LABELS = ("FILE:", "MODIFIED:", "TOKENS:")
+
+def file_header_fields(relative_path, file_tokens, stat_result, config):
+    """Variable parts of a file header, each with the space and newline around it"""
+    file_datetime = datetime.fromtimestamp(stat_result.st_mtime)
+    return (
+        f" {relative_path}\n",
+        f" {file_datetime.strftime('%Y-%m-%d %H:%M:%S')}\n",
+        f" {format_token_count(file_tokens, config)}\n",
+    )
+
+def render_file_header(fields):
+    """Assemble a file header from its variable fields"""
+    lines = [f"{label}{field}" for label, field in zip(FILE_HEADER_LABELS, fields)]
+    return f"{FILE_HEADER_RULE}\n" + "".join(lines) + f"{FILE_HEADER_RULE}\n\n"
+
+def file_header_token_counts(all_fields, encoding_name="cl100k_base"):
+    """Token cost of each file header without re-encoding the header per file
+    
+    The fixed template text is counted once. Tiktoken never merges tokens
+    across a newline or across a label's colon and the following space, so a
+    header's cost is the template cost plus the cost of its fields; distinct
+    field values are encoded once, in one batch.
+    """
+    if get_encoder(encoding_name) is None:
+        # Fallback estimate works on the whole header length, as before
+        fixed_chars = len(render_file_header(("", "", "")))
+        return [(fixed_chars + sum(len(field) for field in fields)) // 4 for fields in all_fields]
+    
+    template_texts = [f"{FILE_HEADER_RULE}\n", f"{FILE_HEADER_RULE}\n\n", *FILE_HEADER_LABELS]
+    fixed_tokens = sum(estimate_tokens_batch(template_texts, encoding_name))
+    
+    unique_fields = list({field for fields in all_fields for field in fields})
+    field_tokens = dict(zip(unique_fields, estimate_tokens_batch(unique_fields, encoding_name)))
+    return [fixed_tokens + sum(field_tokens[field] for field in fields) for fields in all_fields]
+
+def record_section(record, written, header_fields, header_costs, config):
+    """Header fields, header cost, token count and reference flag for writing a record
+    
+    A deduplicated record is written as its reference only once its original
+    has been written (ids in written); if the original was skipped or left
+    out by the budget, the copy falls back to its full content and header.
+    """
+    dedup = record["dedup"]
+    if dedup is None or id(dedup["original"]) in written:
+        return header_fields[id(record)], header_costs[id(record)], record["tokens"], dedup is not None
+    fields = file_header_fields(record["relative_path"], dedup["full_tokens"], record["stat"], config)
+    cost = file_header_token_counts([fields], config["token_config"]["encoding"])[0]
+    return fields, cost, dedup["full_tokens"], False
+
+# Above this many DP cells (files x budget steps) packing falls back to greedy
+PACKING_DP_CELL_LIMIT = 5_000_000
+
+def file_priority_weight(record, matcher, config, now=None):
+    """Priority multiplier for budget packing from directory, extension, recency and backend/frontend"""
+    packing = config.get("packing", DEFAULT_CONFIG["packing"])
+    weight = 1.0
+    
+    # Most specific matching directory rule wins: "js/classes" beats "js"
+    parent = record["relative_path"].parent.as_posix()
+    parts = record["relative_path"].parent.parts
+    best_match = None
+    for key, dir_weight in packing.get("dir_weights", {}).items():
+        key = key.strip("/")
+        if parent == key or parent.startswith(key + "/") or ("/" not in key and key in parts):
+            if best_match is None or len(key) > len(best_match[0]):
+                best_match = (key, dir_weight)
+    if best_match is not None:
+        weight *= best_match[1]
+    
+    weight *= packing.get("extension_weights", {}).get(record["path"].suffix.lstrip('.'), 1.0)
+    
+    if matcher.is_backend(record["relative_path"].as_posix()):
+        weight *= packing.get("backend_weight", 1.0)
+    else:
+        weight *= packing.get("frontend_weight", 1.0)
+    
+    recency_weight = packing.get("recency_weight", 0.0)
+    if recency_weight and record["stat"] is not None:
+        now = time.time() if now is None else now
+        age_hours = max(0.0, now - record["stat"].st_mtime) / 3600
+        half_life = packing.get("recency_half_life_hours", 24) or 24
+        weight *= 1.0 + recency_weight * 0.5 ** (age_hours / half_life)
+    
+    return weight
+
+def pack_files(candidates, capacity):
+    """Choose the candidates that maximize total value within a token capacity
+    
+    candidates is a list of (key, cost, value). This is a 0/1 knapsack solved
+    by dynamic programming over the capacity, with costs scaled up (never
+    down) into at most PACKING_DP_CELL_LIMIT cells so the result always fits.
+    Trees too large for that fall back to greedy by value per token followed
+    by a pass that fills the remaining room. Returns the set of chosen keys.
+    """
+    items = [(key, cost, value) for key, cost, value in candidates if cost <= capacity and value > 0]
+    if not items or capacity <= 0:
+        return set()
+    
+    if sum(cost for _, cost, _ in items) <= capacity:
+        return {key for key, _, _ in items}
+    
+    steps = min(capacity, max(1, PACKING_DP_CELL_LIMIT // len(items)))
+    if steps >= 100:
+        sizes = [max(1, -(-cost * steps // capacity)) for _, cost, _ in items]  # ceil(cost / scale)
+        best = [0.0] * (steps + 1)
+        keep = []
+        for size, (_, _, value) in zip(sizes, items):
+            taken = bytearray(steps + 1)
+            for c in range(steps, size - 1, -1):
+                candidate = best[c - size] + value
+                if candidate > best[c]:
+                    best[c] = candidate
+                    taken[c] = 1
+            keep.append(taken)
+        
+        chosen = set()
+        c = steps
+        for index in range(len(items) - 1, -1, -1):
+            if keep[index][c]:
+                chosen.add(items[index][0])
+                c -= sizes[index]
+        return chosen
+    
+    # Greedy: best value per token first, then anything that still fits
+    chosen = set()
+    remaining = capacity
+    for key, cost, value in sorted(items, key=lambda item: (-item[2] / max(item[1], 1), item[1])):
+        if cost <= remaining:
+            chosen.add(key)
+            remaining -= cost
+    return chosen
+
+def manifest_file_headers(manifest, config):
+    """Build every included file's header fields up front and cost them all in one pass
+    
+    Returns (header_fields, header_costs), both keyed by id(record).
+    """
+    header_fields = {}
+    for directory in manifest["directories"]:
+        for record in directory["files"]:
+            if record["status"] == "included" and record["stat"] is not None:
+                header_fields[id(record)] = file_header_fields(
+                    record["relative_path"], record["tokens"], record["stat"], config
+                )
+    header_costs = dict(zip(
+        header_fields,
+        file_header_token_counts(list(header_fields.values()), config["token_config"]["encoding"])
+    ))
+    return header_fields, header_costs
+
+def pack_manifest(manifest, config, header_fields, header_costs, capacity):
+    """Pick the ids of the manifest records to write under a token capacity
+    
+    Packing may leave a copy's original out, so copies are first costed and
+    valued at their full size. Copies of originals that made it in only cost
+    their reference, and the room that frees is packed again from the rest.
+    """
+    now = time.time()
+    records = [record for directory in manifest["directories"] for record in directory["files"]
+               if id(record) in header_costs]
+    weights = {id(record): file_priority_weight(record, manifest["matcher"], config, now) for record in records}
+    
+    def candidates(pool, written):
+        for record in pool:
+            _, header_cost, tokens, _ = record_section(record, written, header_fields, header_costs, config)
+            yield id(record), header_cost + tokens + 2, max(tokens, 1) * weights[id(record)]
+    
+    packed = pack_files(list(candidates(records, set())), capacity)
+    used = sum(cost for _, cost, _ in candidates([record for record in records if id(record) in packed], packed))
+    rest = [record for record in records if id(record) not in packed]
+    return packed | pack_files(list(candidates(rest, packed)), capacity - used)
+
+def mode_extensions(mode, config):
+    """Extensions a mode includes, as listed in the concatenation header"""
+    if mode == 'all':
+        return list(set(config['backend_extensions'] + config['frontend_extensions']))
+    return config['backend_extensions'] if mode == 'backend' else config['frontend_extensions']
+
+def render_concatenation_header(mode, current_dir, extensions, config, minutes_ago=None, budget=None, part=None,
+                                since=None):
+    """Header at the top of a concatenated output; part is (number, count) for a shard"""
+    header = f"{mode.title()} files from '{current_dir.name}'\n"
+    header += f"Generated: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n"
+    header += f"Mode: {mode}\n"
+    if part is not None:
+        header += f"Part: {part[0]} of {part[1]}\n"
+    if minutes_ago:
+        header += f"Time filter: Files modified in last {minutes_ago} minutes\n"
+    if since:
+        header += f"Changed since: {since}\n"
+    header += f"Included extensions: {', '.join(extensions)}\n"
+    header += f"Tiktoken available: {TIKTOKEN_AVAILABLE}\n"
+    header += f"Encoding: {config['token_config']['encoding']}\n"
+    transforms = config.get("transforms", DEFAULT_CONFIG["transforms"]).get("by_extension", {})
+    if transforms:
+        applied = [f"{extension}: {', '.join(name for name in names if name in TRANSFORMS)}"
+                   for extension, names in transforms.items()
+                   if any(name in TRANSFORMS for name in names)]
+        header += f"Transforms: {'; '.join(applied)}\n"
+    if budget is not None:
+        header += f"Token budget: {budget:,}\n"
+    header += "=" * 50 + "\n\n"
+    return header
+
+@profiled("concatenate_files")
+def concatenate_files(output_file, mode, config, minutes_ago=None, manifest=None, cache=None,
+                      policy=None, budget=None, layout=None, log=print):
+    """Concatenate all included files into a single file with token management
+    
+    With a budget no prompts are shown: pack_files() picks the highest-priority
+    set of files that fits under the budget and they are written in one pass.
+    A layout dict, if given, receives the header's token count and the
+    (section key, offset) of each written file for watch mode to patch.
+    output_file may be a path or an open text stream; progress goes through log.
+    """
+    if manifest is None:
+        manifest = scan_files(mode, config, minutes_ago, cache=cache, log=log)
+    current_dir = manifest["root"]
     files_processed = 0
     files_skipped = 0
     minified_skipped = 0
+    generated_skipped = 0
+    binary_skipped = 0
     time_filtered = 0
     user_skipped = 0
+    budget_skipped = 0
+    over_cap_skipped = 0
+    deduplicated = 0
+    written = set()  # ids of records written so far; copies may only refer back to these
     running_tokens = 0
     
-    if mode == 'all':
-        extensions = list(set(config['backend_extensions'] + config['frontend_extensions']))
-    else:
-        extensions = config['backend_extensions'] if mode == 'backend' else config['frontend_extensions']
+    extensions = mode_extensions(mode, config)
     
-    print(f"Starting {mode} concatenation with real-time token counting...")
-    print(f"Processing extensions: {', '.join(extensions)}")
+    log(f"Starting {mode} concatenation with real-time token counting...")
+    log(f"Processing extensions: {', '.join(extensions)}")
     if minutes_ago:
-        print(f"Time filter: Only files modified in last {minutes_ago} minutes")
-    print(f"Tiktoken available: {TIKTOKEN_AVAILABLE}")
-    print(f"Token thresholds - Yellow: {config['token_config']['yellow_threshold']:,}, Red: {config['token_config']['red_threshold']:,}")
-    
-    with open(output_file, 'w', encoding='utf-8') as outfile:
-        header = f"{mode.title()} files from '{current_dir.name}'\n"
-        header += f"Generated: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n"
-        header += f"Mode: {mode}\n"
-        if minutes_ago:
-            header += f"Time filter: Files modified in last {minutes_ago} minutes\n"
-        header += f"Included extensions: {', '.join(extensions)}\n"
-        header += f"Tiktoken available: {TIKTOKEN_AVAILABLE}\n"
-        header += f"Encoding: {config['token_config']['encoding']}\n"
-        header += "=" * 50 + "\n\n"
-        
+        log(f"Time filter: Only files modified in last {minutes_ago} minutes")
+    if manifest["since"]:
+        log(f"Changed since: {manifest['since']}")
+    log(f"Tiktoken available: {TIKTOKEN_AVAILABLE}")
+    log(f"Token thresholds - Yellow: {config['token_config']['yellow_threshold']:,}, Red: {config['token_config']['red_threshold']:,}")
+    if budget is not None:
+        log(f"Token budget: {budget:,} (packing files by priority, no prompts)")
+    
+    with open_output(output_file, config) as outfile:
+        header = render_concatenation_header(mode, current_dir, extensions, config, minutes_ago, budget,
+                                             since=manifest["since"])
         outfile.write(header)
         running_tokens += estimate_tokens(header, config["token_config"]["encoding"])
         
-        for root, dirs, files in os.walk(current_dir):
-            dirs[:] = [d for d in dirs if not should_ignore_dir(d, config)]
-            
-            for file in files:
-                filepath = Path(root) / file
+        header_tokens = running_tokens
+        header_fields, header_costs = manifest_file_headers(manifest, config)
+        
+        packed = None
+        if budget is not None:
+            packed = pack_manifest(manifest, config, header_fields, header_costs, budget - running_tokens)
+        
+        if layout is not None:
+            layout.update(header_tokens=header_tokens, sections=[])
+        
+        for directory in manifest["directories"]:
+            for record in directory["files"]:
+                filepath = record["path"]
                 
-                if not should_include_file(filepath, current_dir, mode, config):
-                    continue
-                    
-                if should_ignore_file(file, root_name, config):
+                if record["status"] == "ignored":
                     files_skipped += 1
                     continue
                 
-                if is_minified(filepath):
+                if record["status"] == "minified":
                     minified_skipped += 1
                     continue
                 
-                if not is_recently_modified(filepath, minutes_ago):
+                if record["status"] == "generated":
+                    generated_skipped += 1
+                    continue
+                
+                if record["status"] == "binary":
+                    binary_skipped += 1
+                    continue
+                
+                if record["status"] == "time_filtered":
                     time_filtered += 1
                     continue
                 
-                relative_path = filepath.relative_to(current_dir)
+                if record["status"] == "over_cap":
+                    over_cap_skipped += 1
+                    continue
+                
+                if record["status"] == "error":
+                    log(f"Error processing {filepath}: {str(record['error'])}")
+                    continue
+                
+                relative_path = record["relative_path"]
+                
+                if packed is not None and id(record) not in packed:
+                    budget_skipped += 1
+                    continue
                 
                 try:
-                    with open(filepath, 'r', encoding='utf-8') as infile:
-                        content = infile.read()
-                        file_tokens = estimate_tokens(content, config["token_config"]["encoding"])
-                        
-                        # Calculate total tokens if this file were added
-                        file_header = f"{'=' * 50}\n"
-                        file_header += f"FILE: {relative_path}\n"
-                        file_mtime = filepath.stat().st_mtime
-                        file_datetime = datetime.fromtimestamp(file_mtime)
-                        file_header += f"MODIFIED: {file_datetime.strftime('%Y-%m-%d %H:%M:%S')}\n"
-                        file_header += f"TOKENS: {format_token_count(file_tokens, config)}\n"
-                        file_header += f"{'=' * 50}\n\n"
-                        
-                        header_tokens = estimate_tokens(file_header, config["token_config"]["encoding"])
-                        projected_total = running_tokens + header_tokens + file_tokens + 2  # +2 for newlines
-                        
+                    fields, header_tokens, file_tokens, as_reference = record_section(
+                        record, written, header_fields, header_costs, config
+                    )
+                    
+                    # Calculate total tokens if this file were added
+                    file_header = render_file_header(fields)
+                    projected_total = running_tokens + header_tokens + file_tokens + 2  # +2 for newlines
+                    
+                    if packed is not None and projected_total > budget:
+                        # A copy whose original was left out costs its full size
+                        budget_skipped += 1
+                        continue
+                    
+                    if packed is None:
                         # Check if we should prompt user
                         warning_icon = get_file_warning_icon(file_tokens, config)
-                        print(f"\nNext file: {relative_path} {warning_icon}({format_token_count(file_tokens, config)} tokens)")
-                        print(f"Running total would be: {format_token_count(projected_total, config)}")
+                        log(f"\nNext file: {relative_path} {warning_icon}({format_token_count(file_tokens, config)} tokens)")
+                        log(f"Running total would be: {format_token_count(projected_total, config)}")
                         
                         user_choice = prompt_user_continue(
                             projected_total, 
                             config, 
-                            f"Adding file: {relative_path}"
+                            f"Adding file: {relative_path}",
+                            policy
                         )
                         
                         if user_choice is False:
-                            print("Stopping concatenation.")
+                            log("Stopping concatenation.")
                             break
                         elif user_choice == 'skip':
-                            print(f"Skipping: {relative_path}")
+                            log(f"Skipping: {relative_path}")
                             user_skipped += 1
                             continue
-                        
-                        # Add the file
-                        outfile.write(file_header)
-                        outfile.write(content)
-                        outfile.write("\n\n")
-                        
-                        running_tokens = projected_total
-                        files_processed += 1
-                        print(f"✅ Added: {relative_path}")
+                    
+                    # Add the file
+                    if layout is not None:
+                        layout["sections"].append((section_key(record, as_reference), outfile.tell()))
+                    outfile.write(file_header)
+                    write_record_body(outfile, record, config, as_reference)
+                    outfile.write("\n\n")
+                    
+                    written.add(id(record))
+                    running_tokens = projected_total
+                    files_processed += 1
+                    if as_reference:
+                        deduplicated += 1
+                    log(f"✅ Added: {relative_path}")
                 
                 except Exception as e:
-                    print(f"Error processing {filepath}: {str(e)}")
+                    log(f"Error processing {filepath}: {str(e)}")
             else:
                 continue  # Continue to next directory
             break  # Break from outer loop if inner loop was broken
+        
+        if layout is not None:
+            layout["end"] = outfile.tell()
 
     # Final summary
-    print(f"\n{'='*50}")
-    print(f"{mode.title()} CONCATENATION COMPLETE")
-    print(f"{'='*50}")
-    print(f"Files processed: {files_processed}")
-    print(f"Files skipped (ignored): {files_skipped}")
-    print(f"Files skipped (minified): {minified_skipped}")
-    print(f"Files skipped (user): {user_skipped}")
+    log(f"\n{'='*50}")
+    log(f"{mode.title()} CONCATENATION COMPLETE")
+    log(f"{'='*50}")
+    log(f"Files processed: {files_processed}")
+    log(f"Files skipped (ignored): {files_skipped}")
+    log(f"Files skipped (minified): {minified_skipped}")
+    log(f"Files skipped (generated): {generated_skipped}")
+    log(f"Files skipped (binary): {binary_skipped}")
+    log(f"Files skipped (user): {user_skipped}")
+    if deduplicated:
+        log(f"Files written as references to duplicates: {deduplicated}")
+    if budget is not None:
+        log(f"Files skipped (budget): {budget_skipped}")
+    if config["token_config"].get("file_token_cap") is not None:
+        log(f"Files skipped (over file cap): {over_cap_skipped}")
     if minutes_ago:
-        print(f"Files skipped (time filter): {time_filtered}")
-    print(f"Final token count: {format_token_count(running_tokens, config)}")
-    print(f"Status: {get_threshold_status(running_tokens, config).upper()}")
-    print(f"Output saved to: {output_file}")
+        log(f"Files skipped (time filter): {time_filtered}")
+    log(f"Final token count: {format_token_count(running_tokens, config)}")
+    log(f"Status: {get_threshold_status(running_tokens, config).upper()}")
+    log(f"Output saved to: {getattr(output_file, 'name', output_file)}")
     
     return running_tokens
 
+def subtree_ends(directories):
+    """For each walk-ordered directory, the index just past its last descendant"""
+    ends = [len(directories)] * len(directories)
+    open_dirs = []
+    for index, directory in enumerate(directories):
+        while open_dirs and directories[open_dirs[-1]]["depth"] >= directory["depth"]:
+            ends[open_dirs.pop()] = index
+        open_dirs.append(index)
+    return ends
+
+def plan_shards(manifest, config, header_fields, header_costs, capacity, packed=None):
+    """Split the included records into walk-ordered shards of at most capacity tokens each
+    
+    Whole subtrees go into one shard when they fit, starting a new shard
+    rather than splitting one that would fit on its own; a subtree too big
+    for any shard is split into its directories, and a directory too big for
+    one into its files. A single file over capacity gets a shard to itself.
+    Duplicates are costed as references only within their own shard.
+    Returns a list of (records, tokens) pairs; tokens exclude the shard header.
+    """
+    directories = manifest["directories"]
+    groups = [
+        [record for record in directory["files"]
+         if id(record) in header_costs and (packed is None or id(record) in packed)]
+        for directory in directories
+    ]
+    ends = subtree_ends(directories)
+    shards = []
+    current = {"records": [], "written": set(), "tokens": 0}
+    
+    def group_cost(records, written):
+        written = set(written)
+        total = 0
+        for record in records:
+            _, header_tokens, file_tokens, _ = record_section(record, written, header_fields, header_costs, config)
+            total += header_tokens + file_tokens + 2
+            written.add(id(record))
+        return total
+    
+    def start_shard():
+        nonlocal current
+        if current["records"]:
+            shards.append((current["records"], current["tokens"]))
+        current = {"records": [], "written": set(), "tokens": 0}
+    
+    def place(records):
+        current["tokens"] += group_cost(records, current["written"])
+        current["records"].extend(records)
+        current["written"].update(id(record) for record in records)
+    
+    def place_together(records):
+        """Place records in one shard if they fit in some shard; False if they can't"""
+        if current["tokens"] + group_cost(records, current["written"]) <= capacity:
+            place(records)
+            return True
+        if group_cost(records, ()) <= capacity:
+            start_shard()
+            place(records)
+            return True
+        return False
+    
+    index = 0
+    while index < len(directories):
+        subtree = [record for group in groups[index:ends[index]] for record in group]
+        if not subtree or place_together(subtree):
+            index = ends[index]
+            continue
+        if groups[index] and not place_together(groups[index]):
+            for record in groups[index]:
+                if not place_together([record]):
+                    start_shard()
+                    place([record])
+        index += 1
+    start_shard()
+    return shards
+
+def get_shard_filenames(output_file, count):
+    """Part and index filenames for a sharded output: name.part001.txt, ..., name.index.txt"""
+    output_file = Path(output_file)
+    parts = [output_file.with_suffix(f".part{number:03d}{output_file.suffix}") for number in range(1, count + 1)]
+    return parts, output_file.with_suffix(f".index{output_file.suffix}")
+
+def shard_ignore_patterns(output_file):
+    """ignored_files entries matching every part and the index of output_file, whatever the part count"""
+    output_file = Path(output_file)
+    return [f"{output_file.stem}.part*{output_file.suffix}", f"{output_file.stem}.index{output_file.suffix}"]
+
+def write_shard(part_file, records, header, header_fields, header_costs, config):
+    """Write one shard's header and file sections; returns its token count"""
+    written = set()
+    tokens = estimate_tokens(header, config["token_config"]["encoding"])
+    with open_output(part_file, config) as outfile:
+        outfile.write(header)
+        for record in records:
+            fields, header_tokens, file_tokens, as_reference = record_section(
+                record, written, header_fields, header_costs, config
+            )
+            outfile.write(render_file_header(fields))
+            write_record_body(outfile, record, config, as_reference)
+            outfile.write("\n\n")
+            written.add(id(record))
+            tokens += header_tokens + file_tokens + 2
+    return tokens
+
+@profiled("shard_files")
+def shard_files(output_file, mode, config, minutes_ago=None, manifest=None, cache=None,
+                shard_tokens=None, budget=None, log=print):
+    """Write the concatenation as several parts of at most shard_tokens tokens each, plus an index
+    
+    No prompts are shown. With a budget, the files are first packed under it
+    as for concatenate_files, then split into parts; the budget counts one
+    header, not one per part. The parts are planned
+    from the manifest up front and written concurrently. Returns
+    (part files, index file, total tokens across the parts). Progress goes
+    through log.
+    """
+    if manifest is None:
+        manifest = scan_files(mode, config, minutes_ago, cache=cache, log=log)
+    sharding = config.get("sharding", DEFAULT_CONFIG["sharding"])
+    if shard_tokens is None:
+        shard_tokens = sharding.get("shard_tokens") or config["token_config"]["red_threshold"]
+    current_dir = manifest["root"]
+    extensions = mode_extensions(mode, config)
+    encoding_name = config["token_config"]["encoding"]
+    
+    log(f"Starting {mode} concatenation in parts of up to {shard_tokens:,} tokens...")
+    
+    header_fields, header_costs = manifest_file_headers(manifest, config)
+    packed = None
+    if budget is not None:
+        full_header = render_concatenation_header(mode, current_dir, extensions, config, minutes_ago, budget,
+                                                  since=manifest["since"])
+        packed = pack_manifest(manifest, config, header_fields, header_costs,
+                               budget - estimate_tokens(full_header, encoding_name))
+    
+    # Part numbers aren't known until the plan is done; cost the header with the widest ones
+    widest_header = render_concatenation_header(mode, current_dir, extensions, config, minutes_ago, budget,
+                                                part=(999, 999), since=manifest["since"])
+    capacity = shard_tokens - estimate_tokens(widest_header, encoding_name)
+    shards = plan_shards(manifest, config, header_fields, header_costs, capacity, packed)
+    part_files, index_file = get_shard_filenames(output_file, len(shards))
+    part_files = [compressed_filename(part_file, config) for part_file in part_files]
+    
+    threads = max(1, min(sharding.get("write_threads", 4), len(shards)))
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        futures = [
+            executor.submit(
+                write_shard, part_file, records,
+                render_concatenation_header(mode, current_dir, extensions, config, minutes_ago, budget,
+                                            part=(number, len(shards)), since=manifest["since"]),
+                header_fields, header_costs, config,
+            )
+            for number, (part_file, (records, _)) in enumerate(zip(part_files, shards), 1)
+        ]
+        part_tokens = [future.result() for future in futures]
+    
+    with open(index_file, 'w', encoding='utf-8') as index:
+        index.write(f"{mode.title()} files from '{current_dir.name}' in {len(shards)} parts\n")
+        index.write(f"Generated: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n")
+        index.write(f"Part budget: {shard_tokens:,} tokens\n")
+        index.write("=" * 50 + "\n")
+        for part_file, (records, _), tokens in zip(part_files, shards, part_tokens):
+            index.write(f"\n{part_file.name} [{tokens:,} tokens, {len(records)} files]\n")
+            for record in records:
+                index.write(f"  {record['relative_path'].as_posix()}\n")
+    
+    total_tokens = sum(part_tokens)
+    skipped = len(header_costs) - sum(len(records) for records, _ in shards)
+    log(f"\n{'='*50}")
+    log(f"{mode.title()} CONCATENATION COMPLETE ({len(shards)} parts)")
+    log(f"{'='*50}")
+    for part_file, (records, _), tokens in zip(part_files, shards, part_tokens):
+        marker = " (single file over the part budget)" if tokens > shard_tokens else ""
+        log(f"{part_file.name}: {format_token_count(tokens, config)} tokens, {len(records)} files{marker}")
+    if budget is not None:
+        log(f"Files skipped (budget): {skipped}")
+    log(f"Total tokens across parts: {format_token_count(total_tokens, config)}")
+    log(f"Index saved to: {index_file}")
+    
+    return part_files, index_file, total_tokens
+
+def section_key(record, as_reference=False):
+    """Identity of a file's section in the concatenated output; changes whenever its text would"""
+    reference = record["dedup"]["body"] if as_reference else None
+    return (record["relative_path"], record["stat"].st_size, record["stat"].st_mtime_ns, record["tokens"],
+            reference)
+
+def manifest_signature(manifest):
+    """Everything the tree output depends on, for cheap change detection
+    
+    Ignored files only matter through whether their directory has candidates,
+    so our own output files appearing in the root don't count as a change.
+    """
+    signature = []
+    for directory in manifest["directories"]:
+        signature.append((directory["relative_path"], bool(directory["files"])))
+        signature.extend(
+            (record["relative_path"], record["status"], record["tokens"],
+             record["stat"].st_mtime_ns if record["stat"] is not None else None)
+            for record in directory["files"]
+            if record["status"] != "ignored"
+        )
+    return signature
+
+@profiled("patch_concatenation")
+def patch_concatenation(output_file, manifest, config, layout, budget=None):
+    """Rewrite the concatenated output from the first changed file section onward
+    
+    Sections before the first difference stay on disk untouched; every later
+    section is re-rendered from the manifest, which already holds the content.
+    Returns (sections rewritten, total tokens) or None when nothing changed.
+    """
+    header_fields, header_costs = manifest_file_headers(manifest, config)
+    packed = None
+    if budget is not None:
+        packed = pack_manifest(manifest, config, header_fields, header_costs, budget - layout["header_tokens"])
+    
+    selected = [
+        record
+        for directory in manifest["directories"]
+        for record in directory["files"]
+        if id(record) in header_costs and (packed is None or id(record) in packed)
+    ]
+    written = {id(record) for record in selected}
+    parts = [record_section(record, written, header_fields, header_costs, config) for record in selected]
+    total_tokens = layout["header_tokens"] + sum(
+        header_cost + file_tokens + 2 for _, header_cost, file_tokens, _ in parts
+    )
+    
+    old_sections = layout["sections"]
+    new_keys = [section_key(record, part[3]) for record, part in zip(selected, parts)]
+    first = 0
+    while (first < len(old_sections) and first < len(new_keys)
+           and old_sections[first][0] == new_keys[first]):
+        first += 1
+    if first == len(old_sections) == len(new_keys):
+        return None
+    
+    offset = old_sections[first][1] if first < len(old_sections) else layout["end"]
+    sections = old_sections[:first]
+    with open(output_file, 'r+', encoding='utf-8') as outfile:
+        outfile.seek(offset)
+        for record, (fields, _, _, as_reference), key in zip(selected[first:], parts[first:],
+                                                              new_keys[first:]):
+            sections.append((key, outfile.tell()))
+            outfile.write(render_file_header(fields))
+            write_record_body(outfile, record, config, as_reference)
+            outfile.write("\n\n")
+        layout["end"] = outfile.tell()
+        outfile.truncate()
+    layout["sections"] = sections
+    
+    return len(selected) - first, total_tokens
+
+def watch_snapshot(tree_file, concat_file, mode, config, minutes_ago, manifest, layout,
+                   interval=1.0, cache=None, budget=None, jobs=1, manifest_file=None, log=print):
+    """Poll the tree for changes and keep the tree and concatenated outputs current
+    
+    Each poll re-walks and stats the tree but only reads files whose size or
+    mtime changed. The tree is re-rendered from the in-memory manifest and the
+    concatenated output is patched from the first affected section onward.
+    Runs until interrupted; progress goes through log.
+    """
+    log(f"\nWatching for changes every {interval:g}s (Ctrl+C to stop)...")
+    signature = manifest_signature(manifest)
+    
+    while True:
+        time.sleep(interval)
+        manifest = scan_files(mode, config, minutes_ago, current_dir=manifest["root"],
+                              cache=cache, jobs=jobs, previous=manifest, since=manifest["since"],
+                              outputs=[path for path in (tree_file, concat_file, manifest_file) if path is not None],
+                              log=log)
+        if cache is not None and manifest["files_read"]:
+            cache.flush()
+        
+        new_signature = manifest_signature(manifest)
+        if new_signature == signature:
+            continue
+        signature = new_signature
+        
+        started = time.perf_counter()
+        generate_file_tree(tree_file, mode, config, minutes_ago, manifest, log=log)
+        if manifest_file is not None:
+            write_manifest(manifest_file, manifest, config)
+        patched = patch_concatenation(concat_file, manifest, config, layout, budget)
+        elapsed = time.perf_counter() - started
+        
+        stamp = datetime.now().strftime('%H:%M:%S')
+        if patched is None:
+            log(f"[{stamp}] Tree updated ({manifest['files_read']} files re-read, {elapsed:.2f}s)")
+        else:
+            rewritten, total_tokens = patched
+            log(f"[{stamp}] {manifest['files_read']} files re-read, {rewritten} sections rewritten, "
+                  f"total {format_token_count(total_tokens, config)} tokens ({elapsed:.2f}s)")
+
+def discard(*args, **kwargs):
+    """log callable that drops progress messages"""
+
+class Snapshot:
+    """Library entry point: scan one directory tree and render it to any text stream
+    
+    Nothing depends on the current directory, nothing prompts and progress
+    goes through log (discarded by default):
+    
+        with Snapshot("path/to/repo", mode="backend") as snapshot:
+            for record in snapshot.records():
+                ...
+            snapshot.write_concatenation(stream, budget=50000)
+    
+    The scan runs on first use and is kept; rescan() refreshes it, reading
+    only files whose size or mtime changed. Encoders are loaded once per
+    process and the token cache stays open across calls, so a long-lived
+    Snapshot (or several sharing one cache) answers repeated requests warm.
+    The cache is opened next to a config file, in the root for a config
+    dict, or passed in as cache. Like TokenCache, a Snapshot belongs to the thread that created it.
+    """
+    
+    def __init__(self, root, config=None, mode="all", minutes_ago=None, since=None, jobs=1,
+                 cache=None, log=discard):
+        self.root = Path(root).resolve()
+        # The cache lives next to the config file it was loaded from, as for the command line;
+        # a config given as a dict has no file, so its cache goes in the root
+        config_dir = self.root if isinstance(config, dict) else None
+        if config is None or isinstance(config, (str, Path)):
+            if config is not None:
+                config_dir = Path(config).parent
+            config = load_config(config, log)
+        resolved = resolve_compression(config, log)
+        if resolved is not None:
+            config = dict(config, compression={"format": resolved[0], "level": resolved[1]})
+        self.config = config
+        self.mode = mode
+        self.minutes_ago = minutes_ago
+        self.since = since
+        self.jobs = jobs
+        self.log = log
+        self.owns_cache = cache is None
+        self.cache = open_token_cache(config, config_dir, log) if cache is None else cache
+        self.manifest = None
+        get_encoder(config["token_config"]["encoding"], log)
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.close()
+    
+    def rescan(self):
+        """Scan the tree again, reusing the previous scan's records for unchanged files"""
+        self.manifest = scan_files(self.mode, self.config, self.minutes_ago, current_dir=self.root,
+                                   cache=self.cache, jobs=self.jobs, previous=self.manifest,
+                                   since=self.since, log=self.log)
+        if self.cache is not None and self.manifest["files_read"]:
+            self.cache.flush()
+        return self.manifest
+    
+    def scan(self):
+        """The current manifest, scanning the tree if that hasn't happened yet"""
+        if self.manifest is None:
+            self.rescan()
+        return self.manifest
+    
+    def records(self, statuses=("included",)):
+        """Yield file records in walk order; statuses=None yields every candidate, skipped or not
+        
+        The first call runs the whole scan before yielding anything: duplicate
+        detection and directory totals need every record, so records come
+        from the finished manifest rather than streaming out of the walk.
+        """
+        for directory in self.scan()["directories"]:
+            for record in directory["files"]:
+                if statuses is None or record["status"] in statuses:
+                    yield record
+    
+    def write_tree(self, stream):
+        """Render the file tree to stream; returns (total tokens, total files)"""
+        return generate_file_tree(stream, self.mode, self.config, self.minutes_ago, self.scan(), log=self.log)
+    
+    def write_concatenation(self, stream, budget=None, max_tokens=None):
+        """Render the concatenation to stream; returns its token count
+        
+        With a budget the best set of files under it is packed; max_tokens
+        instead skips each file that would push the total past it.
+        """
+        return concatenate_files(stream, self.mode, self.config, self.minutes_ago, self.scan(),
+                                 policy={"yes": True, "max_tokens": max_tokens}, budget=budget, log=self.log)
+    
+    def write_manifest(self, stream):
+        """Render the NDJSON manifest to stream"""
+        write_manifest(stream, self.scan(), self.config)
+    
+    def close(self):
+        """Close the token cache, if this Snapshot opened it"""
+        if self.owns_cache and self.cache is not None:
+            self.cache.close()
+            self.cache = None
+
 def get_user_choice():
     """Get user choice for frontend, backend, or all"""
     while True:
@@ -559,7 +3316,106 @@ def get_time_filter():
         except ValueError:
             print("Please enter a valid number or press Enter for no filter")
 
-if __name__ == "__main__":
+def positive_int(value):
+    """argparse type for counts that must be >= 1"""
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"expected a positive number, got {value}")
+    return number
+
+def parse_args(argv=None):
+    """Parse command-line options; anything left out falls back to the interactive prompts"""
+    parser = argparse.ArgumentParser(description="Enhanced File Concatenator with Token Management")
+    parser.add_argument("--mode", "-m", choices=["frontend", "backend", "all"],
+                        help="files to include (skips the mode and time-filter prompts)")
+    parser.add_argument("--minutes", type=positive_int,
+                        help="only include files modified in the last N minutes")
+    parser.add_argument("--root", "-r", type=Path,
+                        help="directory to snapshot (default: current directory)")
+    parser.add_argument("--output", "-o", type=Path,
+                        help="concatenated output file (default: {root}_{mode}_files.txt in the root)")
+    parser.add_argument("--tree-output", type=Path,
+                        help="file tree output file (default: {root}_{mode}_tree.txt in the root)")
+    parser.add_argument("--config", "-c", type=Path,
+                        help="config file (default: concat_config.json next to this script)")
+    parser.add_argument("--yes", "-y", action="store_true",
+                        help="never prompt at token thresholds; always continue")
+    parser.add_argument("--max-tokens", type=positive_int,
+                        help="never prompt; skip files that would push the total past N tokens")
+    parser.add_argument("--budget", "-b", type=positive_int, nargs="?", const=0,
+                        help="pack the best set of files under N tokens without prompting "
+                             "(no N: packing.budget from the config, else red_threshold)")
+    parser.add_argument("--shard", type=positive_int, nargs="?", const=0, metavar="TOKENS",
+                        help="write {root}_{mode}_files.partNNN.txt parts of at most TOKENS tokens each, "
+                             "plus an index, without prompting "
+                             "(no TOKENS: sharding.shard_tokens from the config, else red_threshold)")
+    parser.add_argument("--watch", "-w", type=float, nargs="?", const=1.0, metavar="SECONDS",
+                        help="keep running and patch the outputs when files change "
+                             "(poll interval, default 1s; implies --yes unless --budget is set)")
+    parser.add_argument("--walk-threads", type=int,
+                        help="threads prefetching directory listings, for slow or network filesystems "
+                             "(default: io.walk_threads from the config)")
+    parser.add_argument("--git", action="store_true",
+                        help="list tracked files from the git index instead of walking the tree")
+    parser.add_argument("--since", metavar="REV",
+                        help="only include files changed since git revision REV (implies --git)")
+    parser.add_argument("--jobs", "-j", type=int, default=1,
+                        help="worker processes for reading and tokenizing (0 = one per CPU)")
+    parser.add_argument("--manifest", type=Path, nargs="?", const=True, metavar="FILE",
+                        help="also write an NDJSON manifest of every scanned file "
+                             "(default: {root}_{mode}_manifest.ndjson in the root)")
+    parser.add_argument("--compress", nargs="?", const="auto", choices=["auto", "gzip", "zstd"],
+                        help="compress the outputs on a background thread, adding .gz or .zst "
+                             "(default: zstd if zstandard is installed, else gzip)")
+    parser.add_argument("--compress-level", type=int, metavar="N",
+                        help="compression level (default: compression.level from the config, else "
+                             "6 for gzip, 3 for zstd)")
+    parser.add_argument("--plain", action="store_true",
+                        help="no ANSI color codes in the outputs or the console")
+    parser.add_argument("--profile", action="store_true",
+                        help="time each pipeline stage and print a summary table at the end")
+    parser.add_argument("--profile-stats", type=Path, metavar="FILE",
+                        help="also run under cProfile and dump pstats to FILE (implies --profile)")
+    parser.add_argument("--profile-trace", type=Path, metavar="FILE",
+                        help="also write every stage pass as a Chrome trace JSON to FILE (implies --profile)")
+    args = parser.parse_args(argv)
+    if args.watch is not None and args.max_tokens is not None:
+        parser.error("--watch cannot re-apply --max-tokens; use --budget to cap a watched snapshot")
+    if args.watch is not None and args.shard is not None:
+        parser.error("--watch cannot patch sharded output; drop --shard to watch")
+    return args
+
+def main(argv=None):
+    """Run a snapshot; returns the process exit code"""
+    args = parse_args(argv)
+    if not (args.profile or args.profile_stats or args.profile_trace):
+        return run_snapshot(args)
+    
+    PROFILER.enable(trace=args.profile_trace is not None)
+    stats_profile = cProfile.Profile() if args.profile_stats else None
+    if stats_profile is not None:
+        stats_profile.enable()
+    try:
+        return run_snapshot(args)
+    finally:
+        if stats_profile is not None:
+            stats_profile.disable()
+            stats_profile.dump_stats(str(args.profile_stats))
+        PROFILER.disable()
+        PROFILER.print_summary()
+        if args.profile_stats:
+            print(f"cProfile stats written to {args.profile_stats} (python -m pstats {args.profile_stats})")
+        if args.profile_trace:
+            PROFILER.write_trace(args.profile_trace)
+            print(f"Trace written to {args.profile_trace}")
+
+def run_snapshot(args):
+    """Run a snapshot from parsed arguments; returns the process exit code"""
+    jobs = args.jobs if args.jobs > 0 else (os.cpu_count() or 1)
+    policy = {"yes": args.yes or args.watch is not None, "max_tokens": args.max_tokens}
+    budget = None
+    shard_tokens = None
+    
     try:
         print("Enhanced File Concatenator with Token Management")
         print(f"Tiktoken available: {TIKTOKEN_AVAILABLE}")
@@ -568,31 +3424,123 @@ if __name__ == "__main__":
             print("Using character÷4 estimation as fallback")
         print()
         
-        config = load_config()
-        mode = get_user_choice()
-        minutes_ago = get_time_filter()
+        config = load_config(args.config)
+        if args.plain:
+            config = dict(config, output=dict(config["output"], ansi_colors=False))
+        if args.walk_threads is not None:
+            config = dict(config, io=dict(config["io"], walk_threads=max(0, args.walk_threads)))
+        if args.git:
+            config = dict(config, io=dict(config["io"], enumerate="git"))
+        compression = config.get("compression", DEFAULT_CONFIG["compression"])
+        if args.compress:
+            compression = dict(compression, format=args.compress)
+        if args.compress_level is not None:
+            compression = dict(compression, level=args.compress_level)
+        if args.watch is not None and compression.get("format"):
+            print("Watch mode patches its outputs in place; writing them uncompressed")
+            compression = dict(compression, format=None)
+        config = dict(config, compression=compression)
+        resolved = resolve_compression(config)  # Settled once, so a zstd fallback is only reported once
+        if resolved is not None:
+            config = dict(config, compression={"format": resolved[0], "level": resolved[1]})
+        if args.budget is not None:
+            budget = args.budget or config["packing"].get("budget") or config["token_config"]["red_threshold"]
+        if args.shard is not None:
+            shard_tokens = (args.shard or config.get("sharding", DEFAULT_CONFIG["sharding"]).get("shard_tokens")
+                            or config["token_config"]["red_threshold"])
+        if args.mode:
+            mode = args.mode
+            minutes_ago = args.minutes
+        else:
+            mode = get_user_choice()
+            minutes_ago = args.minutes if args.minutes else get_time_filter()
         
-        concat_file, tree_file = get_output_filenames(mode, minutes_ago)
+        root_dir = args.root.resolve() if args.root else Path.cwd()
+        concat_file, tree_file = get_output_filenames(mode, minutes_ago, root_dir)
+        if args.root:
+            concat_file, tree_file = root_dir / concat_file, root_dir / tree_file
+        concat_file = args.output or concat_file
+        tree_file = args.tree_output or tree_file
+        manifest_file = None
+        if args.manifest is True:
+            manifest_file = root_dir / get_manifest_filename(mode, minutes_ago, root_dir)
+        elif args.manifest is not None:
+            manifest_file = args.manifest
         
-        # Generate tree first (for overview)
-        total_tree_tokens, total_files = generate_file_tree(tree_file, mode, config, minutes_ago)
+        # Compressed outputs get .gz/.zst added; shard_files adds it to each part itself
+        tree_file = compressed_filename(tree_file, config)
+        if shard_tokens is None:
+            concat_file = compressed_filename(concat_file, config)
+        if manifest_file is not None:
+            manifest_file = compressed_filename(manifest_file, config)
         
-        # Prompt before concatenation if high token count
-        print(f"\nTree analysis complete: {format_token_count(total_tree_tokens, config)} tokens across {total_files} files")
+        # Custom output names must not be picked up by later snapshots either
+        ignored_outputs = [
+            Path(output).name for output in (args.output, args.tree_output, args.manifest)
+            if output and output is not True
+        ]
+        outputs = [path for path in (concat_file, tree_file, manifest_file) if path is not None]
+        if shard_tokens is not None:
+            # Parts left by an earlier run may outnumber this run's, so match them all
+            ignored_outputs += shard_ignore_patterns(concat_file)
+            outputs += [path for pattern in shard_ignore_patterns(concat_file)
+                        for path in Path(concat_file).parent.glob(pattern)]
+        config = dict(config, ignored_files=config["ignored_files"] + ignored_outputs)
         
-        if not prompt_user_continue(total_tree_tokens, config, "Starting concatenation with all files"):
-            print("Concatenation cancelled.")
-        else:
-            final_tokens = concatenate_files(concat_file, mode, config, minutes_ago)
+        # Scan once; the tree and the concatenation both render from the manifest
+        config_dir = args.config.parent if args.config else None
+        cache = open_token_cache(config, config_dir)
+        try:
+            manifest = scan_files(mode, config, minutes_ago, current_dir=root_dir, cache=cache, jobs=jobs,
+                                  since=args.since, outputs=outputs)
+            if cache is not None:
+                print(f"Token cache: {cache.hits} hits, {cache.misses} misses")
+            if manifest_file is not None:
+                write_manifest(manifest_file, manifest, config)
+                print(f"Manifest written to {manifest_file}")
+            
+            # Generate tree first (for overview)
+            total_tree_tokens, total_files = generate_file_tree(tree_file, mode, config, minutes_ago, manifest)
             
-            print(f"\n🎉 All operations complete!")
-            print(f"Tree file: {tree_file}")
-            print(f"Concatenated file: {concat_file}")
-            print(f"Final status: {get_threshold_status(final_tokens, config).upper()}")
+            # Prompt before concatenation if high token count
+            print(f"\nTree analysis complete: {format_token_count(total_tree_tokens, config)} tokens across {total_files} files")
+            
+            if shard_tokens is not None:
+                part_files, index_file, final_tokens = shard_files(concat_file, mode, config, minutes_ago, manifest,
+                                                                  shard_tokens=shard_tokens, budget=budget)
+                
+                print(f"\n🎉 All operations complete!")
+                print(f"Tree file: {tree_file}")
+                print(f"Concatenated parts: {len(part_files)} (listed in {index_file})")
+            elif budget is None and not prompt_user_continue(total_tree_tokens, config, "Starting concatenation with all files", policy):
+                print("Concatenation cancelled.")
+            else:
+                layout = {} if args.watch is not None else None
+                final_tokens = concatenate_files(concat_file, mode, config, minutes_ago, manifest,
+                                                 policy=policy, budget=budget, layout=layout)
+                
+                print(f"\n🎉 All operations complete!")
+                print(f"Tree file: {tree_file}")
+                print(f"Concatenated file: {concat_file}")
+                print(f"Final status: {get_threshold_status(final_tokens, config).upper()}")
+                
+                if args.watch is not None:
+                    watch_snapshot(tree_file, concat_file, mode, config, minutes_ago, manifest, layout,
+                                   interval=args.watch, cache=cache, budget=budget, jobs=jobs,
+                                   manifest_file=manifest_file)
+        finally:
+            if cache is not None:
+                cache.close()
         
     except KeyboardInterrupt:
         print("\n\nOperation cancelled by user.")
+        return 130
     except Exception as e:
         print(f"An error occurred: {str(e)}")
         import traceback
-        traceback.print_exc()
\ No newline at end of file
+        traceback.print_exc()
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,388 @@
+import os
+import sys
+import io
+import copy
+import json
+import time
+import random
+import shutil
+import struct
+import zlib
+import argparse
+import platform
+import tempfile
+import statistics
+import contextlib
+from pathlib import Path
+from datetime import datetime
+
+# Benchmarks for concat2_enhanced.py on synthetic source trees
+import concat2_enhanced as concat
+
+BENCHMARKS = ("generate_file_tree", "concatenate_files", "estimate_tokens", "is_minified")
+
+# Directory names the generator nests files under; a mix of backend and frontend dirs
+DIR_NAMES = [
+    "src", "lib", "core", "api", "models", "services", "utils", "static", "components",
+    "views", "pages", "styles", "assets", "widgets", "helpers", "modules", "features",
+]
+# Ignored directories filled with files the scan has to prune
+IGNORED_DIR_NAMES = ["node_modules", "__pycache__", ".git", "vendor", "logs"]
+TEXT_EXTENSIONS = ["py", "js", "css", "json", "html", "ts", "txt"]
+# Texts whose cut points are easy to get wrong; split counts must match counting them whole
+SEAM_SAMPLES = [
+    "};\n}", "a  b", "x\r\ny", "x = 1;\r\n}\r\n", "a\r\n\r\nb", "if x:\n    return\n}\n",
+    "foo\n  bar\nbaz", "it's a  'quote'\n", "end.\n\n\nnext", "tab\tsep \t val", "12345 678\n9",
+]
+
+def default_spec():
+    """Shape of the synthetic tree; every key can be overridden from the command line"""
+    return {
+        "files": 500,
+        "median_bytes": 4096,
+        "size_sigma": 1.0,        # Log-normal spread of file sizes
+        "max_bytes": 262144,
+        "depth": 4,
+        "dirs": 40,
+        "minified_ratio": 0.05,
+        "binary_ratio": 0.05,
+        "ignored_dirs": 3,
+        "ignored_files": 50,
+        "seed": 1,
+    }
+
+def python_block(rng, index):
+    name = f"handle_{rng.choice(['user', 'order', 'item', 'map', 'tile'])}_{index}"
+    return (
+        f"# Helper {index}: keeps the {name} path readable\n"
+        f"def {name}(request, limit={rng.randint(1, 99)}):\n"
+        f"    \"\"\"Process a request and return the trimmed result\"\"\"\n"
+        f"    values = [item for item in request.get('items', []) if item]\n"
+        f"    if len(values) > limit:\n"
+        f"        values = values[:limit]\n"
+        f"    return {{'count': len(values), 'values': values}}\n\n\n"
+    )
+
+def js_block(rng, index):
+    name = f"render{rng.choice(['Tile', 'Grid', 'Layer', 'Overlay', 'Theme'])}{index}"
+    return (
+        f"/**\n * {name} draws one pass of the map\n */\n"
+        f"function {name}(ctx, grid, options = {{}}) {{\n"
+        f"  const size = options.size || {rng.randint(8, 64)};\n"
+        f"  for (let y = 0; y < grid.length; y++) {{\n"
+        f"    // Rows are drawn top to bottom\n"
+        f"    for (let x = 0; x < grid[y].length; x++) {{\n"
+        f"      ctx.fillRect(x * size, y * size, size, size);\n"
+        f"    }}\n"
+        f"  }}\n"
+        f"  return \"{name}\";\n"
+        f"}}\n\n"
+    )
+
+def css_block(rng, index):
+    return (
+        f"/* Section {index} */\n"
+        f".panel-{index} {{\n"
+        f"    margin: {rng.randint(0, 24)}px;\n"
+        f"    color: #{rng.randrange(0x1000000):06x};\n"
+        f"    display: flex;\n"
+        f"}}\n\n"
+    )
+
+def json_block(rng, index):
+    return json.dumps({f"entry_{index}": {
+        "label": f"Entry {index}",
+        "colors": [f"#{rng.randrange(0x1000000):06x}" for _ in range(3)],
+        "weight": rng.randint(1, 50),
+    }}, indent=2)[1:-1].rstrip() + ",\n"
+
+def text_block(rng, index):
+    words = ["tile", "map", "seed", "theme", "layer", "grid", "river", "forest", "peak", "town"]
+    return " ".join(rng.choice(words) for _ in range(12)) + f" {index}.\n"
+
+def html_block(rng, index):
+    return f"<section id=\"s{index}\">\n  <h2>Section {index}</h2>\n  <p>{text_block(rng, index).strip()}</p>\n</section>\n"
+
+BLOCK_WRITERS = {
+    "py": python_block, "js": js_block, "ts": js_block, "css": css_block,
+    "json": json_block, "html": html_block, "txt": text_block,
+}
+
+def text_content(rng, extension, size):
+    """Readable source of roughly size bytes in the style of the extension"""
+    blocks = []
+    length = 0
+    index = 0
+    while length < size:
+        block = BLOCK_WRITERS[extension](rng, index)
+        blocks.append(block)
+        length += len(block)
+        index += 1
+    content = "".join(blocks)
+    if extension == "json":
+        content = "{\n" + content.rstrip(",\n") + "\n}\n"
+    return content
+
+def minified_content(rng, size):
+    """One long line of dense JavaScript, like a bundler's output"""
+    parts = []
+    length = 0
+    index = 0
+    while length < size:
+        part = f"var a{index}=function(b,c){{return b*{rng.randint(1, 9)}+c}};"
+        parts.append(part)
+        length += len(part)
+        index += 1
+    return "".join(parts)
+
+def png_content(rng, size):
+    """A PNG with a valid signature and IHDR, padded with random bytes to size"""
+    width, height = rng.randint(16, 2048), rng.randint(16, 2048)
+    ihdr = struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0)
+    header = (b'\x89PNG\r\n\x1a\n' + struct.pack('>I', len(ihdr)) + b'IHDR' + ihdr
+              + struct.pack('>I', zlib.crc32(b'IHDR' + ihdr)))
+    return header + rng.randbytes(max(0, size - len(header)))
+
+def generate_synthetic_repo(root, spec):
+    """Write a synthetic source tree under root; returns counts of what was written"""
+    rng = random.Random(spec["seed"])
+    root = Path(root)
+    root.mkdir(parents=True, exist_ok=True)
+
+    # Directory tree: each new dir hangs off a random existing one above max depth
+    directories = [root]
+    depths = {root: 0}
+    for index in range(spec["dirs"]):
+        parents = [path for path in directories if depths[path] < spec["depth"]]
+        parent = rng.choice(parents)
+        path = parent / f"{rng.choice(DIR_NAMES)}_{index}"
+        path.mkdir()
+        directories.append(path)
+        depths[path] = depths[parent] + 1
+
+    stats = {"files": 0, "bytes": 0, "minified": 0, "binary": 0, "ignored": 0}
+    for index in range(spec["files"]):
+        directory = rng.choice(directories)
+        size = int(min(spec["max_bytes"], max(64, rng.lognormvariate(0, spec["size_sigma"]) * spec["median_bytes"])))
+        roll = rng.random()
+        if roll < spec["binary_ratio"]:
+            path = directory / f"image_{index}.png"
+            path.write_bytes(png_content(rng, size))
+            stats["binary"] += 1
+        elif roll < spec["binary_ratio"] + spec["minified_ratio"]:
+            # Half carry a .min name, half are only recognizable from their content
+            suffix = ".min.js" if rng.random() < 0.5 else ".js"
+            path = directory / f"bundle_{index}{suffix}"
+            path.write_text(minified_content(rng, size), encoding='utf-8')
+            stats["minified"] += 1
+        else:
+            extension = rng.choice(TEXT_EXTENSIONS)
+            path = directory / f"file_{index}.{extension}"
+            path.write_text(text_content(rng, extension, size), encoding='utf-8')
+        stats["files"] += 1
+        stats["bytes"] += path.stat().st_size
+
+    for index in range(spec["ignored_dirs"]):
+        ignored = rng.choice(directories) / IGNORED_DIR_NAMES[index % len(IGNORED_DIR_NAMES)]
+        ignored.mkdir(exist_ok=True)
+        for file_index in range(spec["ignored_files"]):
+            (ignored / f"dep_{file_index}.js").write_text(js_block(rng, file_index), encoding='utf-8')
+            stats["ignored"] += 1
+
+    return stats
+
+def time_call(func, repeat):
+    """Run func repeat times; returns min/median/mean wall time in seconds"""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return {
+        "min": min(times),
+        "median": statistics.median(times),
+        "mean": statistics.fmean(times),
+        "runs": repeat,
+    }
+
+@contextlib.contextmanager
+def tokenizer(enabled):
+    """Run with tiktoken on or off; off is the character÷4 fallback"""
+    saved = concat.TIKTOKEN_AVAILABLE, dict(concat._ENCODERS)
+    concat.TIKTOKEN_AVAILABLE = saved[0] and enabled
+    concat._ENCODERS.clear()
+    try:
+        yield
+    finally:
+        concat.TIKTOKEN_AVAILABLE = saved[0]
+        concat._ENCODERS.clear()
+        concat._ENCODERS.update(saved[1])
+
+def check_token_seams(encoding_name):
+    """Samples whose split token counts differ from the whole-text count; empty when cuts are safe
+
+    Each sample is cut where find_token_safe_cut() says, and also fed to
+    count_stream_tokens() split at every character, as streamed reads would.
+    """
+    failures = []
+    for text in SEAM_SAMPLES:
+        whole = concat.estimate_tokens(text, encoding_name)
+        cut = concat.find_token_safe_cut(text)
+        if cut is not None and (concat.estimate_tokens(text[:cut], encoding_name)
+                                + concat.estimate_tokens(text[cut:], encoding_name)) != whole:
+            failures.append((text, cut))
+        for split in range(1, len(text)):
+            if concat.count_stream_tokens([text[:split], text[split:]], encoding_name) != whole:
+                failures.append((text, split))
+    return failures
+
+def run_benchmarks(root, repeat, mode="all"):
+    """Time each benchmark on the tree at root; returns {name: timing}"""
+    config = copy.deepcopy(concat.DEFAULT_CONFIG)
+    config["token_cache"]["enabled"] = False
+    encoding_name = config["token_config"]["encoding"]
+    output_dir = Path(tempfile.mkdtemp(prefix="concat_bench_out_"))
+    policy = {"yes": True, "max_tokens": None}
+
+    # Inputs for the function-level benchmarks, read once up front
+    manifest = concat.scan_files(mode, config, current_dir=root)
+    records = [record for directory in manifest["directories"] for record in directory["files"]]
+    texts = [record["content"] for record in records if record["content"] is not None]
+    sniffed = []
+    for record in records:
+        if record["path"].suffix.lower() in (".js", ".css", ".json", ".svg"):
+            try:
+                sniffed.append((record["path"], record["path"].read_text(encoding='utf-8')))
+            except (OSError, UnicodeDecodeError):
+                pass
+
+    def tree():
+        concat.generate_file_tree(output_dir / "tree.txt", mode, config)
+
+    def concatenate():
+        concat.concatenate_files(output_dir / "files.txt", mode, config, policy=policy)
+
+    def tokens():
+        for text in texts:
+            concat.estimate_tokens(text, encoding_name)
+
+    def minified():
+        for path, content in sniffed:
+            concat.is_minified(path, content)
+
+    results = {}
+    cwd = Path.cwd()
+    try:
+        os.chdir(root)
+        with contextlib.redirect_stdout(io.StringIO()):
+            for name, func in zip(BENCHMARKS, (tree, concatenate, tokens, minified)):
+                results[name] = time_call(func, repeat)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(output_dir, ignore_errors=True)
+
+    text_bytes = sum(len(text.encode('utf-8', 'surrogatepass')) for text in texts)
+    results["estimate_tokens"]["mb_per_second"] = text_bytes / 1048576 / max(results["estimate_tokens"]["median"], 1e-9)
+    return results
+
+def load_history(history_file):
+    """Previous benchmark entries, oldest first"""
+    try:
+        with open(history_file, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return []
+
+def compare_to_previous(entry, history):
+    """Median change per benchmark against the last run with the same spec; returns {key: percent}"""
+    previous = next((old for old in reversed(history)
+                     if old["spec"] == entry["spec"] and old["python"] == entry["python"]), None)
+    if previous is None:
+        return {}
+    changes = {}
+    for tokenizer_name, results in entry["results"].items():
+        for name, timing in results.items():
+            old = previous["results"].get(tokenizer_name, {}).get(name)
+            if old:
+                changes[f"{tokenizer_name}/{name}"] = (timing["median"] / old["median"] - 1) * 100
+    return changes
+
+def parse_args(argv=None):
+    """Command-line options; spec keys map to --files, --median-bytes and so on"""
+    parser = argparse.ArgumentParser(description="Benchmark concat2_enhanced.py on a synthetic source tree")
+    for key, value in default_spec().items():
+        parser.add_argument(f"--{key.replace('_', '-')}", type=type(value), default=value, dest=key)
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per benchmark (median is reported)")
+    parser.add_argument("--tiktoken", choices=("both", "on", "off"), default="both",
+                        help="Tokenizer setups to run")
+    parser.add_argument("--root", type=Path, help="Generate the tree here and keep it (default: a temp dir)")
+    parser.add_argument("--history", type=Path, default=Path(__file__).parent / "concat_bench_history.json",
+                        help="JSON file results are appended to")
+    parser.add_argument("--label", default="", help="Note stored with this run, e.g. a commit id")
+    parser.add_argument("--max-regression", type=float,
+                        help="Exit with status 1 if any median is this many percent slower than last time")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    """Generate a tree, run the benchmarks, append to the history; returns the exit code"""
+    args = parse_args(argv)
+    spec = {key: getattr(args, key) for key in default_spec()}
+    root = args.root.resolve() if args.root else Path(tempfile.mkdtemp(prefix="concat_bench_"))
+
+    setups = {"both": ("tiktoken", "fallback"), "on": ("tiktoken",), "off": ("fallback",)}[args.tiktoken]
+    if "tiktoken" in setups and not concat.TIKTOKEN_AVAILABLE:
+        print("tiktoken is not installed - running the fallback tokenizer only")
+        setups = ("fallback",)
+
+    if "tiktoken" in setups:
+        failures = check_token_seams(concat.DEFAULT_CONFIG["token_config"]["encoding"])
+        for text, index in failures:
+            print(f"Token count changes when {text!r} is cut at {index}")
+        if failures:
+            return 1
+
+    try:
+        print(f"Generating synthetic tree in {root}...")
+        stats = generate_synthetic_repo(root, spec)
+        print(f"  {stats['files']:,} files, {stats['bytes']:,} bytes "
+              f"({stats['minified']} minified, {stats['binary']} binary, {stats['ignored']} in ignored dirs)")
+
+        results = {}
+        for setup in setups:
+            print(f"\nRunning benchmarks ({setup}, {args.repeat} runs each)...")
+            with tokenizer(setup == "tiktoken"):
+                results[setup] = run_benchmarks(root, args.repeat)
+            for name, timing in results[setup].items():
+                print(f"  {name:<20} median {timing['median'] * 1000:9.1f} ms   min {timing['min'] * 1000:9.1f} ms")
+    finally:
+        if not args.root:
+            shutil.rmtree(root, ignore_errors=True)
+
+    entry = {
+        "timestamp": datetime.now().isoformat(timespec='seconds'),
+        "label": args.label,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "spec": spec,
+        "tree": stats,
+        "results": results,
+    }
+    history = load_history(args.history)
+    changes = compare_to_previous(entry, history)
+    history.append(entry)
+    with open(args.history, 'w', encoding='utf-8') as f:
+        json.dump(history, f, indent=2)
+    print(f"\nResults appended to {args.history}")
+
+    if changes:
+        print("\nChange in median against the previous run with the same spec:")
+        for key, percent in changes.items():
+            print(f"  {key:<30} {percent:+7.1f}%")
+    if args.max_regression is not None and any(percent > args.max_regression for percent in changes.values()):
+        print(f"Regression above {args.max_regression}% detected")
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,135 @@
+import os
+import copy
+from pathlib import Path
+
+# Regression tests for concat2_enhanced.py: shard naming and ignores, watch-mode patch offsets
+import concat2_enhanced as concat
+
+def make_config(**token_config):
+    """Default config without the on-disk token cache or color codes"""
+    config = copy.deepcopy(concat.DEFAULT_CONFIG)
+    config["token_cache"]["enabled"] = False
+    config["output"]["ansi_colors"] = False
+    config["token_config"].update(token_config)
+    return config
+
+def write_sources(root, count=4, lines=40):
+    """A few small Python files under root/src; returns their paths"""
+    (root / "src").mkdir(parents=True, exist_ok=True)
+    paths = []
+    for index in range(count):
+        path = root / "src" / f"module_{index}.py"
+        path.write_text("".join(f"def f{index}_{line}(x):\n    return x + {line}\n\n" for line in range(lines)),
+                        encoding='utf-8')
+        paths.append(path)
+    return paths
+
+def scan(root, config, **kwargs):
+    return concat.scan_files("all", config, current_dir=root, log=concat.discard, **kwargs)
+
+def statuses(manifest):
+    return {record["name"]: record["status"] for directory in manifest["directories"]
+            for record in directory["files"]}
+
+def test_shard_filenames():
+    parts, index = concat.get_shard_filenames(Path("out/snap.txt"), 3)
+    assert [part.name for part in parts] == ["snap.part001.txt", "snap.part002.txt", "snap.part003.txt"]
+    assert index.name == "snap.index.txt"
+
+def test_shard_ignore_patterns_cover_every_part(tmp_path):
+    parts, index = concat.get_shard_filenames(tmp_path / "snap.txt", 12)
+    config = make_config()
+    config["ignored_files"] = config["ignored_files"] + concat.shard_ignore_patterns(tmp_path / "snap.txt")
+    matcher = concat.PathMatcher(config, tmp_path.name)
+    for path in parts + [index]:
+        assert matcher.ignores_file(path.name, path.name)
+    assert not matcher.ignores_file("snap.txt.bak", "snap.txt.bak")
+    assert not matcher.ignores_file("summary.txt", "summary.txt")
+
+def test_second_sharded_run_does_not_read_its_parts(tmp_path):
+    write_sources(tmp_path, count=6, lines=200)
+    config = make_config()
+    config["ignored_files"] = config["ignored_files"] + concat.shard_ignore_patterns(tmp_path / "snap.txt")
+
+    first_parts, first_index, _ = concat.shard_files(tmp_path / "snap.txt", "all", config,
+                                                     manifest=scan(tmp_path, config), shard_tokens=3000,
+                                                     log=concat.discard)
+    assert len(first_parts) > 1
+    manifest = scan(tmp_path, config)
+    found = statuses(manifest)
+    assert all(found.get(path.name, "ignored") == "ignored" for path in first_parts + [first_index])
+
+    parts, _, _ = concat.shard_files(tmp_path / "snap.txt", "all", config, manifest=manifest,
+                                     shard_tokens=3000, log=concat.discard)
+    assert [part.stat().st_size for part in parts] == [part.stat().st_size for part in first_parts]
+
+def test_outputs_are_ignored_by_identity(tmp_path):
+    write_sources(tmp_path, count=2)
+    output = tmp_path / "src" / "renamed_output.py"
+    output.write_text("x = 1\n", encoding='utf-8')
+    found = statuses(scan(tmp_path, make_config(), outputs=[output]))
+    assert found["renamed_output.py"] == "ignored"
+    assert found["module_0.py"] == "included"
+
+def test_copy_file_body_refuses_its_own_output(tmp_path):
+    path = tmp_path / "big.txt"
+    path.write_text("line\n" * 1000, encoding='utf-8')
+    with open(path, 'a', encoding='utf-8') as outfile:
+        try:
+            concat.copy_file_body(path, outfile, raw_ok=True)
+        except OSError:
+            pass
+        else:
+            raise AssertionError("copied a file into itself")
+    assert path.stat().st_size == 5000
+
+def included(manifest):
+    return [record for directory in manifest["directories"] for record in directory["files"]
+            if record["status"] == "included"]
+
+def assert_sections_at_offsets(output_file, manifest, layout):
+    data = output_file.read_bytes()
+    records = included(manifest)
+    assert len(layout["sections"]) == len(records)
+    for (key, offset), record in zip(layout["sections"], records):
+        assert key[0] == record["relative_path"]
+        header = f"{concat.FILE_HEADER_RULE}\n{concat.FILE_HEADER_LABELS[0]} {record['relative_path']}\n"
+        assert data[offset:offset + len(header.encode())] == header.encode()
+    assert layout["end"] == len(data)
+
+def test_patch_concatenation_offsets(tmp_path):
+    sources = write_sources(tmp_path)
+    config = make_config()
+    output_file = tmp_path / "out" / "snap.txt"
+    output_file.parent.mkdir()
+    config["ignored_dirs"] = config["ignored_dirs"] + ["out"]
+
+    manifest = scan(tmp_path, config)
+    layout = {}
+    concat.concatenate_files(output_file, "all", config, manifest=manifest,
+                             policy={"yes": True, "max_tokens": None}, layout=layout, log=concat.discard)
+    assert_sections_at_offsets(output_file, manifest, layout)
+    header_end = layout["sections"][0][1]
+
+    # Grow the second file in walk order, so every later section moves
+    changed = included(manifest)[1]["path"]
+    changed.write_text(changed.read_text(encoding='utf-8') + "def added(x):\n    return x\n" * 20,
+                       encoding='utf-8')
+    stat = changed.stat()
+    os.utime(changed, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+    manifest = scan(tmp_path, config, previous=manifest)
+    rewritten, _ = concat.patch_concatenation(output_file, manifest, config, layout)
+    assert rewritten == len(sources) - 1
+    assert_sections_at_offsets(output_file, manifest, layout)
+
+    # The patched body matches a fresh render of the same manifest
+    fresh = tmp_path / "out" / "fresh.txt"
+    fresh_layout = {}
+    concat.concatenate_files(fresh, "all", config, manifest=manifest,
+                             policy={"yes": True, "max_tokens": None}, layout=fresh_layout, log=concat.discard)
+    assert (output_file.read_bytes()[header_end:]
+            == fresh.read_bytes()[fresh_layout["sections"][0][1]:])
+
+    # Nothing changed since: nothing to patch
+    assert concat.patch_concatenation(output_file, scan(tmp_path, config, previous=manifest), config,
+                                      layout) is None